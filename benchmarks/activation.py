@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+#
+#   Copyright 2014 Telenor Digital AS
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#   use this file except in compliance with the License. You may obtain a copy
+#   of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+
+"""Compare ways of activating eggs in pkg_resources' working set.
+
+Synthetic eggs are prepended to sys.path and made known to pkg_resources by
+either reloading the module, as transmute used to, or incrementally adding them
+to the existing working set with bootstrap._activate(). Each measurement is
+taken in a fresh process, and the best of --repeat runs is reported.
+"""
+
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from resolver_scaling import make_basket
+
+_base_dir = os.path.dirname(os.path.abspath(__file__))
+
+MODES = [ 'reload', 'incremental' ]
+
+
+def run(path, mode):
+    """Activate eggs in path, returns seconds taken."""
+
+    sys.path.insert(0, os.path.dirname(_base_dir))
+
+    import pkg_resources
+    import transmute.bootstrap
+
+    entries = [ os.path.join(path, filename)
+            for filename in sorted(os.listdir(path)) ]
+    sys.path[0:0] = entries
+
+    start = time.time()
+    if mode == 'reload':
+        reload(pkg_resources)
+    else:
+        transmute.bootstrap._activate(entries)
+    return time.time() - start
+
+def _run_isolated(path, mode):
+    output = subprocess.check_output([ sys.executable, __file__, '--run', path,
+            mode ])
+    return float(output)
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--eggs', nargs='+', type=int, default=[ 1, 10, 50 ])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--run', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run:
+        path, mode = args.run
+        print run(path, mode)
+        return 0
+
+    print '%6s %12s %12s' % ('eggs', 'reload', 'incremental')
+    for eggs in args.eggs:
+        basket_dir = tempfile.mkdtemp()
+        try:
+            make_basket(basket_dir, 'flat', eggs, 1)
+            timings = [ min(_run_isolated(basket_dir, mode)
+                    for _ in range(args.repeat)) for mode in MODES ]
+        finally:
+            shutil.rmtree(basket_dir, True)
+
+        print '%6d %11.4fs %11.4fs' % tuple([ eggs ] + timings)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
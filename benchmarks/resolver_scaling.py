@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+#
+#   Copyright 2014 Telenor Digital AS
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#   use this file except in compliance with the License. You may obtain a copy
+#   of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+
+"""Scaling benchmark for basket and resolver code.
+
+Synthetic local baskets are generated with a configurable number of projects,
+versions per project and dependency graph shape:
+
+    flat: the root project depends on every other project.
+    chain: each project depends on the next one.
+    tree: project i depends on projects 2i+1 and 2i+2.
+
+For each basket, the following phases are measured, in a fresh process:
+
+    add_package: listing the basket, Basket._initialize().
+    fill_environment: Basket.fill_environment() for the root project.
+    require: bootstrap.require() for the root project.
+    resolve: WorkingSet.resolve() over the full dependency graph.
+    has_conflicts: Transmuter() and Transmuter._has_conflicts().
+
+Distributions listed in a basket carry no metadata until they're made local, so
+bootstrap.require() sees no dependencies and only fetches the root project. The
+require phase thus scales with basket size but not graph shape, which only the
+resolve phase exercises.
+
+Wall time, growth in peak resident memory (resource.getrusage) and growth in
+number of objects tracked by the garbage collector are recorded per phase.
+
+Results are compared against those stored in baseline.json, next to this
+script. A phase is reported as a regression if it is more than --tolerance
+times slower (or bigger) than in the baseline. Run with --save to update the
+baseline.
+"""
+
+import gc
+import json
+import os
+import os.path
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+_base_dir = os.path.dirname(os.path.abspath(__file__))
+_baseline = os.path.join(_base_dir, 'baseline.json')
+
+SHAPES = [ 'flat', 'chain', 'tree' ]
+PHASES = [ 'add_package', 'fill_environment', 'require', 'resolve',
+        'has_conflicts' ]
+
+
+def _project(index):
+    return 'proj%05d' % index
+
+def _dependencies(shape, index, projects):
+    if shape == 'flat':
+        children = range(1, projects) if index == 0 else []
+    elif shape == 'chain':
+        children = [ index + 1 ]
+    elif shape == 'tree':
+        children = [ 2 * index + 1, 2 * index + 2 ]
+    else:
+        raise ValueError('Unknown graph shape: %s' % shape)
+
+    return [ _project(child) for child in children if child < projects ]
+
+def make_basket(path, shape, projects, versions):
+    """Fill directory with synthetic eggs."""
+
+    py_version = '%d.%d' % sys.version_info[:2]
+
+    for index in range(projects):
+        project = _project(index)
+        requires = '\n'.join(_dependencies(shape, index, projects))
+
+        for version in range(versions):
+            filename = '%s-%d.0-py%s.egg' % (project, version, py_version)
+            with zipfile.ZipFile(os.path.join(path, filename), 'w') as egg:
+                egg.writestr('EGG-INFO/PKG-INFO',
+                        'Metadata-Version: 1.0\nName: %s\nVersion: %d.0\n'
+                        % (project, version))
+                egg.writestr('EGG-INFO/requires.txt', requires)
+                egg.writestr('EGG-INFO/top_level.txt', project)
+                egg.writestr('%s/__init__.py' % project, '')
+
+
+class _Probe(object):
+    """Measure a phase."""
+
+    def __init__(self, results, phase):
+        self.results = results
+        self.phase = phase
+
+    def __enter__(self):
+        gc.collect()
+        self.objects = len(gc.get_objects())
+        self.maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        elapsed = time.time() - self.start
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        gc.collect()
+
+        self.results[self.phase] = {
+            'seconds': elapsed,
+            'maxrss_kb': maxrss - self.maxrss,
+            'objects': len(gc.get_objects()) - self.objects,
+        }
+
+def run(path, shape, projects, versions):
+    """Measure phases against basket in path, returns dict of results."""
+
+    sys.path.insert(0, os.path.dirname(_base_dir))
+
+    import pkg_resources
+    import transmute.basket
+    import transmute.bootstrap
+    from transmute.transmuter import Transmuter
+
+    results = {}
+    requirements = list(pkg_resources.parse_requirements([ _project(0) ]))
+
+    basket = transmute.basket.Basket(path=path)
+    with _Probe(results, 'add_package'):
+        basket._initialize()
+
+    environment = pkg_resources.Environment([])
+    with _Probe(results, 'fill_environment'):
+        basket.fill_environment(environment, requirements)
+
+    # Resolves the root project alone, see above
+    entries = []
+    with _Probe(results, 'require'):
+        transmute.bootstrap.require([ basket ], [ _project(0) ], entries)
+
+    full_environment = pkg_resources.Environment([ path ])
+    with _Probe(results, 'resolve'):
+        needed = pkg_resources.WorkingSet([]).resolve(requirements,
+                env=full_environment)
+    results['resolve']['dists'] = len(needed)
+
+    with _Probe(results, 'has_conflicts'):
+        Transmuter([ dist.location for dist in needed ])._has_conflicts()
+
+    return results
+
+def _run_isolated(shape, projects, versions):
+    basket_dir = tempfile.mkdtemp()
+    home = tempfile.mkdtemp()
+    try:
+        make_basket(basket_dir, shape, projects, versions)
+
+        env = os.environ.copy()
+        env['HOME'] = home
+        output = subprocess.check_output([ sys.executable, __file__, '--run',
+                basket_dir, shape, str(projects), str(versions) ], env=env)
+        return json.loads(output)
+    finally:
+        shutil.rmtree(basket_dir, True)
+        shutil.rmtree(home, True)
+
+def _compare(results, baseline, tolerance):
+    """Yield descriptions of regressions against baseline."""
+
+    for config, phases in sorted(results.items()):
+        for phase, measures in sorted(phases.items()):
+            reference = baseline.get(config, {}).get(phase)
+            if reference is None:
+                continue
+
+            # Absolute slack keeps noise in tiny measurements from counting
+            for measure, slack in [ ('seconds', 0.01), ('maxrss_kb', 1024),
+                    ('objects', 1000) ]:
+                limit = reference[measure] * tolerance + slack
+                if measures[measure] > limit:
+                    yield '%s %s: %s %s > %s' % (config, phase, measure,
+                            measures[measure], limit)
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--shapes', nargs='+', choices=SHAPES, default=SHAPES)
+    parser.add_argument('--projects', nargs='+', type=int,
+            default=[ 10, 100, 1000 ])
+    parser.add_argument('--versions', type=int, default=3)
+    parser.add_argument('--tolerance', type=float, default=2.)
+    parser.add_argument('--save', action='store_true',
+            help='store results as the new baseline')
+    parser.add_argument('--run', nargs=4, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run:
+        path, shape, projects, versions = args.run
+        json.dump(run(path, shape, int(projects), int(versions)), sys.stdout)
+        return 0
+
+    results = {}
+    for shape in args.shapes:
+        for projects in args.projects:
+            config = '%s-%d-%d' % (shape, projects, args.versions)
+            results[config] = _run_isolated(shape, projects, args.versions)
+
+            print config
+            for phase in PHASES:
+                measures = results[config][phase]
+                print '    %-16s %8.4fs %8d KB %8d objects' % (phase,
+                        measures['seconds'], measures['maxrss_kb'],
+                        measures['objects'])
+
+    if args.save:
+        with open(_baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+        return 0
+
+    try:
+        with open(_baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    except IOError:
+        return 0
+
+    regressions = list(_compare(results, baseline, args.tolerance))
+    for regression in regressions:
+        print 'REGRESSION:', regression
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
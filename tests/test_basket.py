@@ -0,0 +1,572 @@
+from nose.tools import *
+import email.utils
+import itertools
+import os.path
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+import zipfile
+
+_base_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(_base_dir))
+
+import transmute
+import transmute.basket
+import transmute.bootstrap
+import transmute.state
+
+_tmp = None
+_saved = None
+_urls = ('stub://basket-%d' % i for i in itertools.count())
+
+def setUp():
+    global _tmp, _saved
+    _tmp = tempfile.mkdtemp()
+    _saved = transmute.bootstrap.Basket._cache_dir, \
+            transmute.bootstrap.Basket._unpack_dir, transmute.state._state_dir
+
+    transmute.bootstrap.Basket._cache_dir = os.path.join(_tmp, 'cache')
+    transmute.bootstrap.Basket._unpack_dir = os.path.join(_tmp, 'unpacked')
+    transmute.state._state_dir = os.path.join(_tmp, 'state')
+
+def tearDown():
+    global _tmp
+    transmute.bootstrap.Basket._cache_dir, \
+            transmute.bootstrap.Basket._unpack_dir, \
+            transmute.state._state_dir = _saved
+    shutil.rmtree(_tmp)
+    _tmp = None
+
+
+class StubBasket(transmute.basket.Basket):
+    """Basket failing, or not, as told."""
+
+    backoff = 10.
+    max_backoff = 40.
+    jitter = 0.
+
+    def __init__(self, url, error=None):
+        transmute.basket.Basket.__init__(self, url)
+        self.error = error
+        self.calls = 0
+
+    def initialize_project(self, project_name):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+
+    def check(self, project='foo'):
+        return self._call_hook(self.initialize_project, project)
+
+def _not_found():
+    return urllib2.HTTPError('http://example.com/foo', 404, 'Not Found', {},
+            None)
+
+def _circuit(basket):
+    state = transmute.state.load(transmute.state.basket_key(basket))
+    return state.get('circuit')
+
+def test_failure_opens_circuit():
+    basket = StubBasket(next(_urls), IOError('Unreachable'))
+
+    assert_false(basket.check())
+    assert_equals(1, basket.calls)
+    assert_equals(1, _circuit(basket)['failures'])
+
+    # Open circuit, hook is not called
+    assert_false(basket.check('bar'))
+    assert_equals(1, basket.calls)
+
+def test_open_circuit_persists():
+    url = next(_urls)
+    assert_false(StubBasket(url, IOError('Unreachable')).check())
+
+    basket = StubBasket(url)
+    assert_false(basket.check())
+    assert_equals(0, basket.calls)
+
+def test_half_open_success_closes_circuit():
+    basket = StubBasket(next(_urls), IOError('Unreachable'))
+    assert_false(basket.check())
+
+    # Backoff expired, a single attempt goes through
+    basket._circuit['retry_at'] = 0
+    basket.error = None
+    assert_true(basket.check())
+    assert_equals(2, basket.calls)
+    assert_equals({}, _circuit(basket))
+
+def test_half_open_failure_doubles_backoff():
+    basket = StubBasket(next(_urls), IOError('Unreachable'))
+    basket._load_state()
+
+    for failures, backoff in [ (1, 10.), (2, 20.), (3, 40.), (4, 40.) ]:
+        basket._circuit['retry_at'] = 0
+
+        start = time.time()
+        assert_false(basket.check())
+        circuit = _circuit(basket)
+        assert_equals(failures, circuit['failures'])
+        assert_almost_equal(backoff, circuit['retry_at'] - start, delta=1.)
+
+def test_not_found_is_cached():
+    url = next(_urls)
+    basket = StubBasket(url, _not_found())
+    assert_true(basket.check())
+    assert_equals(1, basket.calls)
+    assert_false(_circuit(basket))
+
+    # Cached across instances, for the project only
+    basket = StubBasket(url, _not_found())
+    assert_true(basket.check())
+    assert_equals(0, basket.calls)
+    assert_true(basket.check('bar'))
+    assert_equals(1, basket.calls)
+
+def test_not_found_expires():
+    basket = StubBasket(next(_urls), _not_found())
+    assert_true(basket.check())
+
+    basket._not_found['foo'] = 0
+    basket.error = None
+    assert_true(basket.check())
+    assert_equals(2, basket.calls)
+    assert_false('foo' in basket._not_found)
+
+class HangingBasket(StubBasket):
+    """Basket whose hook only fails after some time."""
+
+    def initialize_project(self, project_name):
+        time.sleep(.1)
+        StubBasket.initialize_project(self, project_name)
+
+def _with_budget(budget, function, *args):
+    previous, transmute.bootstrap._budget.budget = \
+            transmute.bootstrap._budget.budget, budget
+    try:
+        return function(*args)
+    finally:
+        transmute.bootstrap._budget.budget = previous
+
+def test_expired_budget_keeps_circuit_closed():
+    basket = StubBasket(next(_urls), IOError('Timed out'))
+
+    # Expired before the hook started
+    budget = transmute.bootstrap._Budget(time.time() - 1)
+    assert_false(_with_budget(budget, basket.check))
+
+    assert_equals(1, basket.calls)
+    assert_false(_circuit(basket))
+    assert_equals([ '%s (initialize_project foo)' % basket.url ],
+            budget.skipped)
+
+def test_hook_running_into_deadline_opens_circuit():
+    basket = HangingBasket(next(_urls), IOError('Timed out'))
+
+    budget = transmute.bootstrap._Budget(time.time() + .05)
+    assert_false(_with_budget(budget, basket.check))
+    assert_true(budget.expired())
+
+    assert_equals(1, basket.calls)
+    assert_equals(1, _circuit(basket)['failures'])
+
+def _throttled(retry_after):
+    return urllib2.HTTPError('http://example.com/foo', 503, 'Slow Down',
+            { 'Retry-After': retry_after }, None)
+
+def test_retry_after_seconds():
+    assert_equals(120., transmute.basket._retry_after(_throttled('120'), 5.))
+    assert_equals(0., transmute.basket._retry_after(_throttled('-3'), 5.))
+
+def test_retry_after_date():
+    date = email.utils.formatdate(time.time() + 60, usegmt=True)
+    assert_almost_equal(60., transmute.basket._retry_after(_throttled(date),
+            5.), delta=2.)
+
+def test_retry_after_default():
+    assert_equals(5., transmute.basket._retry_after(_throttled('soon'), 5.))
+    assert_equals(5., transmute.basket._retry_after(_not_found(), 5.))
+
+class _Sleeps(object):
+    """Record calls to transmute.basket._sleep, instead of sleeping."""
+
+    def __enter__(self):
+        self.sleeps = []
+        self.saved = transmute.basket._sleep
+        transmute.basket._sleep = self.sleeps.append
+        return self.sleeps
+
+    def __exit__(self, *exc_info):
+        transmute.basket._sleep = self.saved
+
+def test_token_bucket():
+    bucket = transmute.basket._TokenBucket(10)
+
+    with _Sleeps() as sleeps:
+        # Full bucket, no waiting
+        bucket.consume(10)
+        assert_equals([], sleeps)
+
+        # In debt, wait for it to be paid back
+        bucket.consume(5)
+        bucket.consume(5)
+
+    assert_equals(2, len(sleeps))
+    assert_almost_equal(.5, sleeps[0], delta=.1)
+    assert_almost_equal(1., sleeps[1], delta=.1)
+
+def test_token_bucket_refills():
+    bucket = transmute.basket._TokenBucket(10, capacity=20)
+    bucket.tokens = 0
+    bucket.updated -= 5 # Refilled, up to capacity
+
+    with _Sleeps() as sleeps:
+        bucket.consume(20)
+        assert_equals([], sleeps)
+
+        bucket.consume(1)
+    assert_almost_equal(.1, sleeps[0], delta=.05)
+
+def test_download_limits():
+    try:
+        transmute.basket.set_download_limits(requests=5)
+        assert_equals(5, transmute.basket._download_requests.rate)
+        assert_equals(None, transmute.basket._download_bandwidth)
+
+        assert_raises(ValueError, transmute.basket.set_download_limits, 0)
+        assert_raises(ValueError, transmute.basket.set_download_limits,
+                bandwidth=-1)
+    finally:
+        transmute.basket.set_download_limits()
+    assert_equals(None, transmute.basket._download_requests)
+
+def test_throttled_backoff():
+    basket = StubBasket(next(_urls), _throttled('0'))
+
+    # A short Retry-After doesn't shorten the backoff...
+    start = time.time()
+    assert_false(basket.check())
+    assert_almost_equal(10., _circuit(basket)['retry_at'] - start, delta=1.)
+
+    # ... a long one extends it
+    basket._circuit['retry_at'] = 0
+    basket.error = _throttled('100')
+    start = time.time()
+    assert_false(basket.check())
+    assert_almost_equal(100., _circuit(basket)['retry_at'] - start, delta=1.)
+
+def test_first_check_splay():
+    url = next(_urls)
+    basket = StubBasket(url)
+    basket.check_interval = 60.
+    basket.splay = 30.
+
+    with _Sleeps() as sleeps:
+        assert_true(basket.check())
+        assert_true(basket.check('bar'))
+    assert_equals(1, len(sleeps))
+    assert_true(0 <= sleeps[0] < 30.)
+
+    # Not on later checks, even once the interval has passed
+    basket = StubBasket(url)
+    basket.check_interval = 60.
+    basket.splay = 30.
+    basket._load_state()
+    for project in basket._next_check:
+        basket._next_check[project] = 0
+
+    with _Sleeps() as sleeps:
+        assert_true(basket.check())
+    assert_equals([], sleeps)
+    assert_equals(1, basket.calls)
+
+def _concurrently(function, threads=8):
+    """Call function from several threads at once, returns results."""
+
+    results = []
+    start = threading.Event()
+    def run():
+        start.wait()
+        results.append(function())
+
+    workers = [ threading.Thread(target=run) for _ in range(threads) ]
+    for worker in workers:
+        worker.start()
+    start.set()
+    for worker in workers:
+        worker.join()
+    return results
+
+class SlowBasket(transmute.basket.Basket):
+    """Basket taking its time to answer, providing a single egg."""
+
+    created = 0
+
+    def __init__(self, url):
+        SlowBasket.created += 1
+        time.sleep(.05)
+        transmute.basket.Basket.__init__(self, url)
+        self.calls = []
+
+    def initialize(self):
+        self.calls.append('initialize')
+        time.sleep(.05)
+
+    def initialize_project(self, project_name):
+        self.calls.append(project_name)
+        time.sleep(.05)
+        self.add_package('slowegg-1.0-py%d.%d.egg' % sys.version_info[:2])
+
+    def fetch(self, dist, metadata):
+        self.calls.append('fetch')
+        time.sleep(.05)
+        with zipfile.ZipFile(dist.location, 'w') as egg:
+            egg.writestr('EGG-INFO/PKG-INFO',
+                    'Metadata-Version: 1.0\nName: slowegg\nVersion: 1.0\n')
+
+def test_concurrent_get_basket():
+    transmute.basket.register_basket_factory('slow', SlowBasket)
+    url = next(_urls).replace('stub:', 'slow:')
+    created = SlowBasket.created
+
+    baskets = _concurrently(lambda: transmute.basket.get_basket(url))
+    assert_equals(1, SlowBasket.created - created)
+    assert_equals(1, len(set(map(id, baskets))))
+
+def test_concurrent_initialize_project():
+    basket = SlowBasket(next(_urls))
+
+    results = _concurrently(lambda: basket._initialize()
+            and basket._initialize_project('slowegg'))
+    assert_equals([ True ] * 8, results)
+    assert_equals([ 'initialize', 'slowegg' ], basket.calls)
+    assert_equals(1, len(basket.list_distributions()))
+
+def test_concurrent_require():
+    basket = SlowBasket(next(_urls))
+    resolver = transmute.Resolver(sources=[ basket ])
+    resolver.entries[:] = []
+
+    _concurrently(lambda: resolver.require([ 'slowegg' ]))
+    assert_equals([ 'initialize', 'slowegg', 'fetch' ], basket.calls)
+    assert_equals([ os.path.join(basket.path, 'slowegg-1.0-py%d.%d.egg'
+            % sys.version_info[:2]) ], resolver.entries)
+
+_MIRRORED_EGG = 'mirrored-1.0-py%d.%d.egg' % sys.version_info[:2]
+
+def _write_egg(filename, project='mirrored', modules=()):
+    with zipfile.ZipFile(filename, 'w') as egg:
+        egg.writestr('EGG-INFO/PKG-INFO',
+                'Metadata-Version: 1.0\nName: %s\nVersion: 1.0\n' % project)
+        for module in modules:
+            egg.writestr('%s/__init__.py' % module, 'NAME = %r\n' % project)
+
+class MirrorStub(transmute.basket.Basket):
+    """Mirror answering after delay, listing eggs, or failing."""
+
+    def __init__(self, delay=0., eggs=(), error=None):
+        transmute.basket.Basket.__init__(self, next(_urls))
+        self.delay = delay
+        self.eggs = eggs
+        self.error = error
+        self.calls = []
+        transmute.basket.register_basket(self)
+
+    def initialize_project(self, project_name):
+        self.calls.append(project_name)
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        for egg in self.eggs:
+            self.add_package(egg, egg)
+
+    def fetch(self, dist, metadata):
+        self.calls.append('fetch')
+        if self.error is not None:
+            raise self.error
+        _write_egg(dist.location)
+
+def _mirror(*mirrors, **attributes):
+    basket = transmute.basket.MirrorBasket('mirror:' + ','.join(
+            mirror if isinstance(mirror, basestring) else mirror.url
+            for mirror in mirrors))
+    for name, value in attributes.items():
+        setattr(basket, name, value)
+    return basket
+
+def _fill(basket):
+    import pkg_resources
+
+    environment = pkg_resources.Environment([])
+    basket.fill_environment(environment,
+            list(pkg_resources.parse_requirements([ 'mirrored' ])))
+    return [ str(dist) for dist in environment[ 'mirrored' ] ]
+
+def test_mirror_ranking():
+    first, second, third = MirrorStub(), MirrorStub(), MirrorStub()
+    basket = _mirror(first, second, third)
+
+    # In order given, with no history
+    assert_equals([ first, second, third ], basket._ranked())
+
+    # Faster first...
+    basket.stats[first].latency = [ 1. ]
+    basket.stats[second].latency = [ .5 ]
+    basket.stats[third].latency = [ .1 ]
+    assert_equals([ third, second, first ], basket._ranked())
+
+    # ... unless failing
+    basket.stats[third].errors = 1
+    assert_equals([ second, first, third ], basket._ranked())
+
+def test_mirror_hedges_slow_mirror():
+    slow = MirrorStub(delay=1., eggs=[ _MIRRORED_EGG ])
+    fast = MirrorStub(eggs=[ _MIRRORED_EGG ])
+    basket = _mirror(slow, fast, hedge_delay=.05)
+
+    start = time.time()
+    assert_equals([ 'mirrored 1.0' ], _fill(basket))
+    assert_true(time.time() - start < .5)
+    assert_equals([ 'mirrored' ], fast.calls)
+
+def test_mirror_not_hedged_when_fast():
+    first = MirrorStub(eggs=[ _MIRRORED_EGG ])
+    second = MirrorStub(eggs=[ _MIRRORED_EGG ])
+    basket = _mirror(first, second, hedge_delay=1.)
+
+    assert_equals([ 'mirrored 1.0' ], _fill(basket))
+    assert_equals([], second.calls)
+
+def test_mirror_failure_falls_over():
+    failing = MirrorStub(error=IOError('Unreachable'))
+    healthy = MirrorStub(eggs=[ _MIRRORED_EGG ])
+    basket = _mirror(failing, healthy, hedge_delay=1.)
+
+    assert_equals([ 'mirrored 1.0' ], _fill(basket))
+    assert_equals(1, basket.stats[failing].errors)
+    assert_equals(0, basket.stats[healthy].errors)
+
+def test_mirror_lacking_projects():
+    empty = MirrorStub()
+    lagging = MirrorStub(delay=.1, eggs=[ _MIRRORED_EGG ])
+    basket = _mirror(empty, lagging, hedge_delay=1.)
+
+    start = time.time()
+    assert_equals([ 'mirrored 1.0' ], _fill(basket))
+    assert_true(time.time() - start < .5)
+
+    # Answering without the project is not a failure
+    assert_equals(0, basket.stats[empty].errors)
+
+def test_mirror_race_timeout():
+    hung = MirrorStub(delay=2., eggs=[ _MIRRORED_EGG ])
+    empty = MirrorStub()
+    basket = _mirror(hung, empty, hedge_delay=.05, race_timeout=.2)
+
+    start = time.time()
+    assert_equals([], _fill(basket))
+    assert_true(time.time() - start < 1.)
+
+def _listed(*mirrors):
+    # Mirrors that already answered all contribute to the listing
+    for mirror in mirrors:
+        mirror._initialize()
+        mirror._initialize_project('mirrored')
+
+def test_mirror_fetch_prefers_local_copy():
+    local_dir = os.path.join(_tmp, 'local-mirror')
+    os.mkdir(local_dir)
+    _write_egg(os.path.join(local_dir, _MIRRORED_EGG))
+
+    remote = MirrorStub(eggs=[ _MIRRORED_EGG ])
+    local = transmute.basket.get_basket(local_dir)
+    _listed(remote, local)
+
+    basket = _mirror(remote, local_dir)
+    _fill(basket)
+
+    dist, = basket.list_distributions()
+    assert_equals(dist.location, basket.make_local(dist))
+    assert_true(os.path.isfile(dist.location))
+    assert_equals([ 'mirrored' ], remote.calls)
+
+def test_mirror_fetch_from_fastest():
+    failing = MirrorStub(eggs=[ _MIRRORED_EGG ])
+    healthy = MirrorStub(eggs=[ _MIRRORED_EGG ])
+    _listed(failing, healthy)
+
+    basket = _mirror(failing, healthy)
+    _fill(basket)
+
+    failing.error = IOError('Unreachable')
+    dist, = basket.list_distributions()
+    basket.make_local(dist)
+    assert_true(os.path.isfile(dist.location))
+    assert_equals([ 'mirrored', 'fetch' ], failing.calls)
+    assert_equals([ 'mirrored', 'fetch' ], healthy.calls)
+
+_UNPACKED_EGG = 'unpacked-1.0-py%d.%d.egg' % sys.version_info[:2]
+
+def _require_unpacked():
+    basket_dir = os.path.join(_tmp, 'unpacked-basket')
+    if not os.path.isdir(basket_dir):
+        os.mkdir(basket_dir)
+        _write_egg(os.path.join(basket_dir, _UNPACKED_EGG), 'unpacked',
+                [ 'unpacked_module' ])
+
+    resolver = transmute.Resolver(sources=[ basket_dir ], unpack=True)
+    resolver.entries[:] = []
+    resolver.require([ 'unpacked' ])
+    return resolver.entries
+
+def _unpacked():
+    unpack_dir = transmute.bootstrap.Basket._unpack_dir
+    return sorted(os.listdir(unpack_dir)) if os.path.isdir(unpack_dir) else []
+
+def _clear_unpacked():
+    shutil.rmtree(transmute.bootstrap.Basket._unpack_dir, True)
+
+@with_setup(_clear_unpacked)
+def test_unpack():
+    location, = _require_unpacked()
+
+    # Extracted into a directory for this version of the egg
+    directory, = _unpacked()
+    assert_true(directory.startswith(_UNPACKED_EGG + '-'))
+    assert_equals(os.path.join(transmute.bootstrap.Basket._unpack_dir,
+            directory, _UNPACKED_EGG), location)
+    assert_true(os.path.isdir(os.path.join(location, 'EGG-INFO')))
+    assert_true(os.path.isfile(os.path.join(location, 'unpacked_module',
+            '__init__.pyc')))
+
+    # Extracted once
+    mtime = os.path.getmtime(location)
+    assert_equals([ location ], _require_unpacked())
+    assert_equals([ directory ], _unpacked())
+    assert_equals(mtime, os.path.getmtime(location))
+
+@with_setup(_clear_unpacked)
+def test_unpack_lost_race():
+    renames = []
+    rename = os.rename
+    def racing_rename(source, destination):
+        # Another process got there first
+        renames.append(destination)
+        shutil.copytree(source, destination)
+        raise OSError('Directory not empty')
+
+    os.rename = racing_rename
+    try:
+        location, = _require_unpacked()
+    finally:
+        os.rename = rename
+
+    # The winner's copy is used, ours is cleaned up
+    assert_equals(1, len(renames))
+    directory, = _unpacked()
+    assert_equals(os.path.join(transmute.bootstrap.Basket._unpack_dir,
+            directory, _UNPACKED_EGG), location)
+    assert_true(os.path.isdir(os.path.join(location, 'unpacked_module')))
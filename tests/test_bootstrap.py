@@ -45,3 +45,61 @@ def check_main(path):
             env=env, stderr=subprocess.STDOUT)
     
     assert_equals(expected_output, output)
+
+_activate_script = '''
+import json, os, sys
+path, old, mode = sys.argv[1:]
+sys.path.insert(0, %r)
+
+import pkg_resources
+import transmute.bootstrap
+
+# An older version, active to begin with
+sys.path.append(old)
+pkg_resources.working_set.add_entry(old)
+
+entries = [ os.path.join(path, name) for name in sorted(os.listdir(path))
+        if name.endswith('.egg') ]
+sys.path[0:0] = entries
+if mode == 'reload':
+    reload(pkg_resources)
+else:
+    transmute.bootstrap._activate(entries)
+
+working_set = pkg_resources.working_set
+json.dump({
+    'entries': [ entry for entry in working_set.entries if entry in entries ],
+    'dists': sorted(str(dist) for dist in working_set
+        if dist.location in entries),
+    'require': [ str(dist) for dist in pkg_resources.require('activated') ],
+}, sys.stdout)
+''' % os.path.dirname(os.path.abspath(_base_dir))
+
+def test_activate():
+    import json
+    import zipfile
+
+    path = tempfile.mkdtemp()
+    old = os.path.join(path, 'old')
+    os.mkdir(old)
+    try:
+        for directory, project, version in [ (path, 'activated', '1.0'),
+                (path, 'other', '2.0'), (old, 'activated', '0.5') ]:
+            filename = '%s-%s-py%d.%d.egg' % ((project, version)
+                    + sys.version_info[:2])
+            with zipfile.ZipFile(os.path.join(directory, filename), 'w') \
+                    as egg:
+                egg.writestr('EGG-INFO/PKG-INFO',
+                        'Metadata-Version: 1.0\nName: %s\nVersion: %s\n'
+                        % (project, version))
+
+        results = [ json.loads(subprocess.check_output([ sys.executable,
+                '-c', _activate_script, path, old, mode ]))
+                for mode in [ 'reload', 'incremental' ] ]
+    finally:
+        shutil.rmtree(path)
+
+    reloaded, activated = results
+    assert_equals(2, len(activated['dists']))
+    assert_true(activated['require'][0].startswith('activated 1.0'))
+    assert_equals(reloaded, activated)
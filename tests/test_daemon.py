@@ -0,0 +1,106 @@
+from nose.tools import *
+import itertools
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import threading
+import zipfile
+
+_base_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(_base_dir))
+
+import transmute
+import transmute.basket
+import transmute.bootstrap
+import transmute.state
+from transmute.daemon import Daemon, _RequestHandler, _Server
+
+_tmp = None
+_saved = None
+_urls = ('budget://basket-%d' % i for i in itertools.count())
+
+def setUp():
+    global _tmp, _saved
+    _tmp = tempfile.mkdtemp()
+    _saved = transmute.bootstrap.Basket._cache_dir, transmute.state._state_dir
+
+    transmute.bootstrap.Basket._cache_dir = os.path.join(_tmp, 'cache')
+    transmute.state._state_dir = os.path.join(_tmp, 'state')
+
+def tearDown():
+    global _tmp
+    transmute.bootstrap.Basket._cache_dir, transmute.state._state_dir = _saved
+    shutil.rmtree(_tmp)
+    _tmp = None
+
+_EGG = 'served-1.0-py%d.%d.egg' % sys.version_info[:2]
+
+def make_source():
+    """Local basket providing a single egg."""
+
+    source = tempfile.mkdtemp(dir=_tmp)
+    with zipfile.ZipFile(os.path.join(source, _EGG), 'w') as egg:
+        egg.writestr('EGG-INFO/PKG-INFO',
+                'Metadata-Version: 1.0\nName: served\nVersion: 1.0\n')
+    return source
+
+class serving(object):
+    """Serve daemon on a free loopback port for the duration of a block."""
+
+    def __init__(self, daemon):
+        self.server = _Server(('127.0.0.1', 0), _RequestHandler)
+        self.server.transmute_daemon = daemon
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        return 'transmute://127.0.0.1:%d' % self.server.server_address[1]
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+def test_round_trip():
+    daemon = Daemon([ make_source() ])
+
+    with serving(daemon) as url:
+        basket = transmute.basket.DaemonBasket(url)
+        resolver = transmute.Resolver(sources=[ basket ])
+        resolver.entries[:] = []
+        resolver.require([ 'served' ])
+
+        assert_equals(set([ 'served' ]), daemon.projects)
+        assert_equals([ os.path.join(basket.path, _EGG) ], resolver.entries)
+        assert_true(os.path.isfile(resolver.entries[0]))
+
+        # Listed empty, rather than failing
+        assert_true(basket._initialize_project('missing'))
+        assert_equals(set([ 'served', 'missing' ]), daemon.projects)
+        assert_equals(1, len(basket.list_distributions()))
+
+class BudgetBasket(transmute.basket.Basket):
+    """Basket noting the time budget hooks are called with."""
+
+    budgets = []
+
+    def initialize_project(self, project_name):
+        self.budgets.append(transmute.bootstrap._budget.time_left())
+
+def test_budgets():
+    transmute.basket.register_basket_factory('budget', BudgetBasket)
+    daemon = Daemon([ next(_urls) ], interval=60.)
+    daemon.request_budget = 3.
+
+    with serving(daemon) as url:
+        basket = transmute.basket.DaemonBasket(url)
+        assert_true(basket._initialize()
+                and basket._initialize_project('budgeted'))
+
+    daemon.refresh()
+
+    request, refresh = BudgetBasket.budgets
+    assert_almost_equal(3., request, delta=1.)
+    assert_almost_equal(60., refresh, delta=1.)
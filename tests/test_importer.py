@@ -0,0 +1,244 @@
+from nose.tools import *
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+
+_base_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(_base_dir))
+
+import pkg_resources
+import transmute.importer
+from transmute.importer import IndexedImporter, LazyImporter, top_level
+from transmute.transmuter import Transmuter
+
+_tmp = None
+_saved = None
+
+def setUp():
+    global _tmp, _saved
+    _tmp = tempfile.mkdtemp()
+    _saved = transmute.importer._cache_dir, list(sys.path)
+    transmute.importer._cache_dir = os.path.join(_tmp, 'top_level')
+
+def tearDown():
+    global _tmp
+    # Lazily imported eggs are added to sys.path
+    transmute.importer._cache_dir, sys.path[:] = _saved
+    shutil.rmtree(_tmp)
+    _tmp = None
+
+def make_egg(project, modules, namespace_packages=()):
+    """Zipped egg providing modules, each one defining NAME."""
+
+    path = os.path.join(_tmp, '%s-1.0-py%d.%d.egg'
+            % (project, sys.version_info[0], sys.version_info[1]))
+    with zipfile.ZipFile(path, 'w') as egg:
+        egg.writestr('EGG-INFO/PKG-INFO',
+                'Metadata-Version: 1.0\nName: %s\nVersion: 1.0\n' % project)
+        egg.writestr('EGG-INFO/top_level.txt', '\n'.join(modules))
+        if namespace_packages:
+            egg.writestr('EGG-INFO/namespace_packages.txt',
+                    '\n'.join(namespace_packages))
+        for module in modules:
+            egg.writestr('%s/__init__.py' % module, 'NAME = %r\n' % project)
+    return path
+
+def test_top_level():
+    egg = make_egg('toplevel', [ 'tl_one', 'tl_two' ])
+
+    assert_equals([ 'tl_one', 'tl_two' ], top_level(egg))
+    assert_equals(1, len(os.listdir(transmute.importer._cache_dir)))
+
+    # Cached away from the egg
+    assert_equals([ os.path.basename(egg) ],
+            [ name for name in os.listdir(_tmp)
+                if name.startswith('toplevel') ])
+
+    # Served from the cache, while the egg keeps its modification time
+    mtime = os.path.getmtime(egg)
+    os.remove(egg)
+    make_egg('toplevel', [ 'tl_three' ])
+    os.utime(egg, (mtime, mtime))
+    assert_equals([ 'tl_one', 'tl_two' ], top_level(egg))
+
+    os.utime(egg, (mtime + 10, mtime + 10))
+    assert_equals([ 'tl_three' ], top_level(egg))
+
+def test_top_level_missing():
+    assert_equals(None, top_level(os.path.join(_tmp, 'missing.egg')))
+
+def test_indexed_lookup():
+    egg = make_egg('indexed', [ 'idx_module' ])
+
+    importer = IndexedImporter()
+    assert_true(importer.add(egg))
+    assert_equals(egg, importer.index['idx_module'])
+
+    # Only top-level modules are indexed
+    assert_equals(None, importer.find_module('idx_module', [ _tmp ]))
+    assert_equals(None, importer.find_module('idx_other'))
+
+    loader = importer.find_module('idx_module')
+    assert_not_equals(None, loader)
+    try:
+        module = loader.load_module('idx_module')
+        assert_equals('indexed', module.NAME)
+    finally:
+        sys.modules.pop('idx_module', None)
+
+def test_indexed_name_clash():
+    first = make_egg('first', [ 'clash_module' ])
+    second = make_egg('second', [ 'clash_module', 'clash_other' ])
+
+    importer = IndexedImporter()
+    assert_true(importer.add(first))
+    assert_false(importer.add(second))
+
+    # Left entirely to sys.path
+    assert_equals({ 'clash_module': first }, importer.index)
+
+def test_indexed_namespace_packages():
+    plain = make_egg('plain', [ 'ns_plain' ])
+    namespaced = make_egg('namespaced', [ 'ns_package' ],
+            namespace_packages=[ 'ns_package' ])
+
+    transmuter = Transmuter([ plain, namespaced ], indexed=True)
+    indexed = [ dist.project_name for dist in transmuter.working_set
+            if transmuter._index(dist) ]
+
+    assert_equals([ 'plain' ], indexed)
+    assert_equals([ 'ns_plain' ], transmuter.importer.index.keys())
+
+
+class StubBasket(object):
+    """Make eggs local by copying them, taking some time, from source.
+
+    Like Basket, a lock is held while fetching, unless told not to wait.
+    """
+
+    def __init__(self, source, delay=0.):
+        self.source = source
+        self.delay = delay
+        self.fetched = []
+        self._lock = threading.Lock()
+
+    def make_local(self, dist, unpack=False, wait=True):
+        if wait:
+            with self._lock:
+                return self.make_local(dist, unpack, False)
+
+        if not os.path.isfile(dist.location):
+            time.sleep(self.delay)
+            import contextlib # Imports while fetching
+            shutil.copy(os.path.join(self.source,
+                    os.path.basename(dist.location)), dist.location)
+            self.fetched.append(dist)
+        return dist.location
+
+def make_deferred(project, modules, delay=0.):
+    egg = make_egg(project, modules)
+    basket_dir = tempfile.mkdtemp(dir=_tmp)
+
+    location = os.path.join(basket_dir, os.path.basename(egg))
+    dist = pkg_resources.Distribution.from_location(location,
+            os.path.basename(location))
+    dist._transmute_basket = StubBasket(os.path.dirname(egg), delay)
+    dist._transmute_top_level = modules
+    dist._transmute_unpack = False
+    dist._transmute_fallback = None
+    return dist
+
+def test_lazy_import():
+    dist = make_deferred('lazy', [ 'lazy_module' ])
+
+    importer = LazyImporter()
+    assert_true(importer.add(dist))
+    importer.install()
+    try:
+        import lazy_module
+        assert_equals('lazy', lazy_module.NAME)
+        assert_equals([ dist ], dist._transmute_basket.fetched)
+        assert_equals([], importer.pending)
+        assert_true(dist.location in sys.path)
+    finally:
+        importer.uninstall()
+        sys.modules.pop('lazy_module', None)
+
+def test_lazy_prefetch():
+    dist = make_deferred('prefetched', [ 'prefetched_module' ], delay=.2)
+
+    importer = LazyImporter()
+    importer.add(dist)
+    importer.install()
+    try:
+        thread = importer.prefetch()
+
+        # Unrelated imports go on meanwhile...
+        start = time.time()
+        import xml.dom.minidom
+        assert_true(time.time() - start < .1)
+
+        # ... while this one fetches alongside, holding the import lock that
+        # the prefetch thread then waits for
+        import prefetched_module
+        assert_equals('prefetched', prefetched_module.NAME)
+
+        thread.join(5)
+        assert_false(thread.is_alive())
+        assert_equals(set([ dist ]), set(dist._transmute_basket.fetched))
+    finally:
+        importer.uninstall()
+        sys.modules.pop('prefetched_module', None)
+
+def test_lazy_import_threads():
+    dist = make_deferred('dependency', [ 'lazy_dependency' ], delay=.2)
+
+    package = os.path.join(_tmp, 'lazy_app')
+    os.mkdir(package)
+    with open(os.path.join(package, '__init__.py'), 'w') as init:
+        init.write('import lazy_dependency\nREADY = True\n')
+    sys.path.insert(0, _tmp)
+
+    importer = LazyImporter()
+    importer.add(dist)
+    importer.install()
+    try:
+        # Neither thread sees the package half-initialized
+        ready = []
+        start = threading.Event()
+        def run():
+            start.wait()
+            import lazy_app
+            ready.append(getattr(lazy_app, 'READY', False))
+
+        threads = [ threading.Thread(target=run) for _ in range(2) ]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join(5)
+
+        assert_equals([ True, True ], ready)
+        assert_equals([ dist ], dist._transmute_basket.fetched)
+    finally:
+        importer.uninstall()
+        sys.modules.pop('lazy_app', None)
+        sys.modules.pop('lazy_dependency', None)
+
+def test_lazy_failed_fetch():
+    dist = make_deferred('failing', [ 'failing_module' ])
+    dist._transmute_basket.source = os.path.join(_tmp, 'nonexistent')
+
+    importer = LazyImporter()
+    importer.add(dist)
+    importer.install()
+    try:
+        assert_raises(ImportError, __import__, 'failing_module')
+        assert_equals([ dist ], importer.failed)
+    finally:
+        importer.uninstall()
@@ -0,0 +1,110 @@
+from nose.tools import *
+import os
+import os.path
+import py_compile
+import shutil
+import sys
+import tempfile
+import zipfile
+
+_base_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(_base_dir))
+
+import pkg_resources
+from transmute.profiler import ImportProfiler
+
+_tmp = None
+
+def setUp():
+    global _tmp
+    _tmp = tempfile.mkdtemp()
+
+def tearDown():
+    global _tmp
+    shutil.rmtree(_tmp)
+    _tmp = None
+
+_PKG_INFO = 'Metadata-Version: 1.0\nName: %s\nVersion: 1.0\n'
+
+def _egg_name(project):
+    return '%s-1.0-py%d.%d.egg' % ((project,) + sys.version_info[:2])
+
+def make_zipped(project, module, bytecode=False):
+    """Zipped egg providing module, optionally byte-compiled."""
+
+    path = os.path.join(_tmp, _egg_name(project))
+    with zipfile.ZipFile(path, 'w') as egg:
+        egg.writestr('EGG-INFO/PKG-INFO', _PKG_INFO % project)
+        source = os.path.join(_tmp, '%s.py' % module)
+        with open(source, 'w') as module_file:
+            module_file.write('NAME = %r\n' % project)
+        egg.write(source, '%s.py' % module)
+        if bytecode:
+            py_compile.compile(source)
+            egg.write(source + 'c', '%s.pyc' % module)
+    return path
+
+def make_directory(project, module):
+    """Extracted, byte-compiled egg providing module."""
+
+    path = os.path.join(_tmp, _egg_name(project))
+    os.makedirs(os.path.join(path, 'EGG-INFO'))
+    with open(os.path.join(path, 'EGG-INFO', 'PKG-INFO'), 'w') as pkg_info:
+        pkg_info.write(_PKG_INFO % project)
+
+    source = os.path.join(path, '%s.py' % module)
+    with open(source, 'w') as module_file:
+        module_file.write('NAME = %r\n' % project)
+    py_compile.compile(source)
+    return path
+
+def profile(entries, modules):
+    """Import modules from entries with a profiler installed."""
+
+    working_set = pkg_resources.WorkingSet(entries)
+    profiler = ImportProfiler(working_set)
+
+    saved = list(sys.path)
+    sys.path[0:0] = entries + [ _tmp ]
+    profiler.install()
+    try:
+        for module in modules:
+            __import__(module)
+    finally:
+        profiler.uninstall()
+        sys.path[:] = saved
+        for module in modules:
+            sys.modules.pop(module, None)
+
+    return dict((str(dist) if dist else None, entry)
+            for dist, entry in profiler.report().items())
+
+def test_report():
+    zipped = make_zipped('zipped', 'prof_zipped')
+    precompiled = make_zipped('precompiled', 'prof_precompiled', True)
+    directory = make_directory('directory', 'prof_directory')
+    with open(os.path.join(_tmp, 'prof_outside.py'), 'w') as outside:
+        outside.write('NAME = None\n')
+
+    report = profile([ zipped, precompiled, directory ], [ 'prof_zipped',
+            'prof_precompiled', 'prof_directory', 'prof_outside' ])
+
+    assert_equals(set([ 'zipped 1.0', 'precompiled 1.0', 'directory 1.0',
+            None ]), set(report))
+
+    assert_equals('zip', report['zipped 1.0']['location'])
+    assert_equals('zip', report['precompiled 1.0']['location'])
+    assert_equals('directory', report['directory 1.0']['location'])
+    assert_equals(None, report[None]['location'])
+
+    def source(dist, module):
+        return report[dist]['modules'][module][1]
+
+    assert_equals('compiled', source('zipped 1.0', 'prof_zipped'))
+    assert_equals('bytecode', source('precompiled 1.0', 'prof_precompiled'))
+    assert_equals('bytecode', source('directory 1.0', 'prof_directory'))
+    assert_equals('compiled', source(None, 'prof_outside'))
+
+    for entry in report.values():
+        assert_almost_equal(entry['seconds'],
+                sum(seconds for seconds, _ in entry['modules'].values()))
@@ -16,21 +16,30 @@ try: from transmute._version import __version__
 except ImportError: __version__ = 'unknown'
 
 import transmute.basket
-from transmute.bootstrap import PYPI_BASKET
+from transmute.basket import DaemonBasket, PyPIBasket
 from transmute.resolver import Resolver
 from transmute.s3 import S3Basket
 from transmute.transmuter import Transmuter
 
+PYPI_BASKET = PyPIBasket(PyPIBasket.pypi_url)
 PYPI_SOURCE = PYPI_BASKET.url
 transmute.basket.register_basket(PYPI_BASKET)
 transmute.basket.register_basket_factory('s3', S3Basket)
+transmute.basket.register_basket_factory('mirror',
+        transmute.basket.MirrorBasket)
+transmute.basket.register_basket_factory('transmute', DaemonBasket)
 
 _resolver = Resolver()
 add_source = _resolver.add_source
 require = _resolver.require
+set_budget = _resolver.set_budget
+skipped = _resolver.skipped
 
-def update(resolver=None):
+def update(resolver=None, profile_imports=False, indexed=False,
+        prefetch=False):
     if resolver is None:
         resolver = globals()['_resolver']
-    tm = Transmuter(resolver.entries)
+    tm = Transmuter(resolver.entries, profile_imports, indexed,
+            resolver.deferred, prefetch)
     tm.transmute()
+    return tm
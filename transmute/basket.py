@@ -12,11 +12,28 @@
 #   License for the specific language governing permissions and limitations
 #   under the License.
 
+import contextlib
+import email.utils
+import json
+import os
+import os.path
+import Queue
+import random
 import re
-from transmute.bootstrap import Basket
+import shutil
+import tempfile
+import threading
+import time
+import transmute.bootstrap
+import transmute.importer
+import transmute.state
+import urllib
+import urllib2
+from transmute.bootstrap import _download, _urlopen
 
 _basket_factory = {}
 _basket = {}
+_basket_lock = threading.RLock()
 
 _SCHEME_REGEX = re.compile("^[a-z][a-z0-9+.-]*$")
 def register_basket_factory(scheme, factory):
@@ -24,7 +41,8 @@ def register_basket_factory(scheme, factory):
     _basket_factory[scheme] = factory
 
 def register_basket(basket):
-    _basket[basket.url] = basket
+    with _basket_lock:
+        _basket[basket.url] = basket
 
 def _get_basket(url):
     scheme, colon, _ = url.partition(':')
@@ -36,6 +54,592 @@ def _get_basket(url):
     return Basket(path=url)
 
 def get_basket(url):
-    if url not in _basket:
-        _basket[url] = _get_basket(url)
-    return _basket[url]
+    with _basket_lock:
+        if url not in _basket:
+            _basket[url] = _get_basket(url)
+        return _basket[url]
+
+
+def _sleep(seconds):
+    """Sleep, unless that would take us past the time budget."""
+
+    left = transmute.bootstrap._budget.time_left()
+    if left is not None \
+            and seconds >= left:
+        raise RuntimeError('Time budget exhausted')
+    time.sleep(seconds)
+
+def _is_throttled(error):
+    return isinstance(error, urllib2.HTTPError) and error.code in (429, 503)
+
+def _retry_after(error, default):
+    """Delay requested in the Retry-After header of error, if any."""
+
+    headers = error.info()
+    value = headers and headers.get('Retry-After')
+    if value:
+        try: return max(0., float(value))
+        except ValueError: pass
+
+        date = email.utils.parsedate_tz(value)
+        if date:
+            return max(0., email.utils.mktime_tz(date) - time.time())
+    return default
+
+
+def _copy_file(source, filename):
+    """Atomically copy source to filename. Content is not verified."""
+
+    dst = tempfile.NamedTemporaryFile(suffix='.download',
+            dir=os.path.dirname(filename), delete=False)
+    try:
+        with contextlib.closing(dst):
+            with open(source, 'rb') as src:
+                shutil.copyfileobj(src, dst)
+        os.rename(dst.name, filename)
+    except:
+        try: os.remove(dst.name)
+        except: pass
+        raise
+
+
+class _TokenBucket(object):
+    """Limit the rate of some resource, allowing for bursts up to capacity."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = capacity or self.rate
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, tokens=1):
+        """Take tokens from the bucket, waiting for them as needed."""
+
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.capacity,
+                    self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            # Go into debt, wait for it to be paid back
+            self.tokens -= tokens
+            wait = -self.tokens / self.rate
+
+        if wait > 0:
+            _sleep(wait)
+
+
+class _ThrottledStream(object):
+
+    def __init__(self, stream, bucket):
+        self.stream = stream
+        self.bucket = bucket
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.bucket.consume(len(data))
+        return data
+
+    def close(self):
+        self.stream.close()
+
+
+_download_requests = None
+_download_bandwidth = None
+
+def set_download_limits(requests=None, bandwidth=None):
+    """Limit the rate of downloads in this process.
+
+    requests: downloads started per second, None for no limit.
+    bandwidth: bytes downloaded per second, None for no limit.
+    """
+    for name, limit in ('requests', requests), ('bandwidth', bandwidth):
+        if limit is not None and limit <= 0:
+            raise ValueError('%s limit must be positive: %r' % (name, limit))
+
+    global _download_requests, _download_bandwidth
+    _download_requests = requests and _TokenBucket(requests)
+    _download_bandwidth = bandwidth and _TokenBucket(bandwidth)
+
+def throttle_download(stream):
+    """Wrap stream to honor the bandwidth limit set for downloads."""
+
+    if _download_bandwidth is None:
+        return stream
+    return _ThrottledStream(stream, _download_bandwidth)
+
+
+class _SingleFlight(object):
+    """Hand out one lock per key.
+
+    Holding a key's lock while doing the work associated with it lets
+    concurrent callers wait for, and then share, the outcome of the work already
+    in flight.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {}
+
+    def lock(self, key):
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+
+class Basket(transmute.bootstrap.Basket):
+    """A container for Python Eggs, mindful of the sources it polls.
+
+    Failures to reach a basket open a circuit breaker, persisted across runs.
+    While it is open, remote hooks are skipped outright. Once the backoff period
+    expires a single attempt is let through, closing the circuit on success or
+    doubling the backoff on failure. Requests throttled by the source hold off
+    for as long as the source asks for in Retry-After.
+
+    Projects the basket reports as non-existent are not queried again for
+    not_found_ttl seconds.
+
+    Successful checks are not repeated for check_interval seconds, relying on
+    cached packages in the meantime. Intervals and backoff periods are
+    stretched by a random factor of up to jitter, so that hosts started at the
+    same time don't keep polling sources in lockstep. With a check_interval,
+    the very first check of a basket is also delayed by up to splay seconds.
+
+    Baskets are safe for concurrent use. Concurrent requests for the basket's
+    listing, or the same project, share a single query.
+
+    In lazy mode, top-level modules of local eggs are remembered per project,
+    so that later versions can be fetched on first import (see Resolver).
+    """
+
+    backoff = 10.
+    max_backoff = 3600.
+    not_found_ttl = 3600.
+    check_interval = 0.
+    jitter = .5
+    splay = 0.
+
+    def __init__(self, url=None, path=None):
+        transmute.bootstrap.Basket.__init__(self, url, path)
+        self._lock = threading.RLock()
+        self._flights = _SingleFlight()
+        self._splayed = False
+
+    def _initialize(self):
+        with self._flights.lock(None):
+            return transmute.bootstrap.Basket._initialize(self)
+
+    def _initialize_project(self, project):
+        with self._flights.lock(project):
+            return transmute.bootstrap.Basket._initialize_project(self,
+                    project)
+
+    def add_package(self, filename, metadata=None):
+        with self._lock:
+            transmute.bootstrap.Basket.add_package(self, filename, metadata)
+
+    def list_distributions(self):
+        """Snapshot of distributions currently in the basket."""
+
+        with self._lock:
+            return [ dist for project_dists in self.distributions.values()
+                    for dist in project_dists ]
+
+    def fill_environment(self, environment, requirements=None):
+        self._initialize()
+
+        for req in requirements or []:
+            self._initialize_project(req.project_name)
+
+        for dist in self.list_distributions():
+            environment.add(dist)
+
+    def _jittered(self, seconds):
+        return seconds * (1 + self.jitter * random.random())
+
+    def _load_state(self):
+        if hasattr(self, '_circuit'):
+            return
+
+        state = transmute.state.load(transmute.state.basket_key(self))
+        self._circuit = state.get('circuit') or {}
+
+        now = time.time()
+        self._not_found = dict((project, until)
+                for project, until in (state.get('not_found') or {}).items()
+                if until > now)
+        # Kept once expired, a basket without any has never been checked
+        self._next_check = state.get('next_check') or {}
+        self._top_levels = state.get('top_level') or {}
+
+    def _save_state(self):
+        transmute.state.update(transmute.state.basket_key(self), {
+            'circuit': self._circuit,
+            'not_found': self._not_found,
+            'next_check': self._next_check,
+            'top_level': self._top_levels,
+        })
+
+    @staticmethod
+    def _is_not_found(error):
+        return isinstance(error, urllib2.HTTPError) and error.code == 404
+
+    def _call_hook(self, hook, *args):
+        # initialize_project(project)
+        project = args[0] if args else None
+
+        with self._lock:
+            self._load_state()
+            now = time.time()
+
+            if project in self._not_found \
+                    and self._not_found[project] > now:
+                return True
+
+            if self._circuit.get('retry_at', 0) > now:
+                return False
+
+            # Checked recently enough, go with what's in the cache
+            if self._next_check.get(project or '', 0) > now:
+                return True
+
+            splay = 0.
+            if self.check_interval and self.splay \
+                    and not self._next_check and not self._splayed:
+                self._splayed = True
+                splay = random.random() * self.splay
+
+        # Spread out first checks from hosts started together, unless that
+        # would eat up the time budget
+        if splay:
+            try: _sleep(splay)
+            except RuntimeError: pass
+
+        errors = []
+        not_found = []
+        def checked_hook(*args):
+            try: hook(*args)
+            except Exception as error:
+                if project is None \
+                        or not self._is_not_found(error):
+                    errors.append(error)
+                    raise
+                not_found.append(project)
+        checked_hook.__name__ = hook.__name__
+
+        # Running out of time before even asking is not the basket's fault,
+        # a hook running into the deadline however counts as a failure
+        expired = transmute.bootstrap._budget.expired()
+        ok = transmute.bootstrap.Basket._call_hook(self, checked_hook, *args)
+
+        with self._lock:
+            if not ok:
+                if not expired:
+                    self._open_circuit(errors[-1] if errors else None)
+                return False
+
+            changed = bool(self._circuit)
+            self._circuit = {}
+
+            if not_found:
+                changed = True
+                self._not_found[project] = now + self.not_found_ttl
+            elif project in self._not_found:
+                changed = True
+                del self._not_found[project]
+
+            if self.check_interval:
+                changed = True
+                self._next_check[project or ''] = \
+                        now + self._jittered(self.check_interval)
+
+            if changed:
+                self._save_state()
+            return True
+
+    def _open_circuit(self, error=None):
+        failures = self._circuit.get('failures', 0) + 1
+        backoff = min(self.max_backoff, self.backoff * 2 ** (failures - 1))
+        if _is_throttled(error):
+            # Hold off for at least as long as the source asks
+            backoff = max(backoff, _retry_after(error, 0.))
+        backoff = self._jittered(backoff)
+
+        self._circuit = { 'failures': failures,
+                'retry_at': time.time() + backoff }
+        self._save_state()
+
+    def make_local(self, dist, unpack=False, wait=True):
+        """Returns location of local copy of dist, fetching it as needed.
+
+        Concurrent requests for the same egg share a single download. Without
+        wait, the egg is fetched regardless of downloads already in flight.
+        Downloads are atomic, so this is safe, if wasteful.
+        """
+        if not wait:
+            return self._make_local(dist, unpack)
+
+        with self._flights.lock(dist.location):
+            return self._make_local(dist, unpack)
+
+    def _make_local(self, dist, unpack):
+        if _download_requests is not None \
+                and not os.path.isfile(dist.location):
+            _download_requests.consume()
+        return transmute.bootstrap.Basket.make_local(self, dist, unpack)
+
+    def _remember_top_level(self, dist):
+        # Kept in basket state, the egg's own directory is left alone
+        names = transmute.importer.top_level(dist.location)
+        with self._lock:
+            self._load_state()
+            if names and self._top_levels.get(dist.key) != names:
+                self._top_levels[dist.key] = names
+                self._save_state()
+
+    def _top_level(self, dist):
+        # Top-level modules are assumed not to change between versions
+        with self._lock:
+            self._load_state()
+            return self._top_levels.get(dist.key)
+
+
+class PyPIBasket(Basket, transmute.bootstrap.PyPIBasket):
+    """A proxy basket for eggs available in PyPI, with circuit breaker."""
+
+    def fetch(self, dist, metadata):
+        _download(throttle_download(_urlopen(metadata['url'])),
+                dist.location, metadata['md5_digest'])
+
+
+class _MirrorStats(object):
+    """Latency and error statistics for a basket, persisted across runs."""
+
+    max_samples = 32
+
+    def __init__(self, basket):
+        self.key = transmute.state.basket_key(basket)
+        self._lock = threading.Lock()
+
+        stats = transmute.state.load(self.key).get('mirror', {})
+        try:
+            self.latency = [ float(sample)
+                    for sample in stats.get('latency', []) ]
+            self.errors = int(stats.get('errors', 0))
+        except:
+            self.latency, self.errors = [], 0
+
+    def percentile(self, percent, default=None):
+        with self._lock:
+            samples = sorted(self.latency)
+        if not samples:
+            return default
+        return samples[int(round(percent / 100. * (len(samples) - 1)))]
+
+    def success(self, latency=None):
+        with self._lock:
+            if latency is not None:
+                self.latency.append(latency)
+                del self.latency[:-self.max_samples]
+            self.errors = 0
+        self.save()
+
+    def failure(self):
+        with self._lock:
+            self.errors += 1
+        self.save()
+
+    def save(self):
+        with self._lock:
+            stats = { 'latency': list(self.latency), 'errors': self.errors }
+            transmute.state.update(self.key, { 'mirror': stats })
+
+
+class MirrorBasket(Basket):
+    """A group of equivalent baskets, expected to hold the same eggs.
+
+    The url takes the form 'mirror:<source>,<source>,...'. Mirrors are queried
+    fastest first. A slower mirror is only queried if faster ones fail, or don't
+    answer within their usual latency (a hedged request). Eggs are downloaded
+    from the fastest healthy mirror listing them.
+    """
+
+    hedge_percentile = 90
+
+    # Hedging delay for mirrors with no recorded history
+    hedge_delay = 0.25
+
+    # Longest wait for mirrors still running, shortened by the time budget
+    race_timeout = 60.
+
+    def __init__(self, url):
+        assert url.startswith('mirror:')
+
+        Basket.__init__(self, url)
+        self.mirrors = [ get_basket(source)
+                for source in url[7:].split(',') if source ]
+        self.stats = dict(
+                (mirror, _MirrorStats(mirror)) for mirror in self.mirrors)
+        self._sources = {}
+
+    def _rank(self, mirror):
+        stats = self.stats[mirror]
+        return stats.errors > 0, stats.percentile(50, 0.), \
+                self.mirrors.index(mirror)
+
+    def _ranked(self, mirrors=None):
+        return sorted(self.mirrors if mirrors is None else mirrors,
+                key=self._rank)
+
+    def _race(self, task, mirrors):
+        """Run task(mirror) on mirrors, hedging against slow ones.
+
+        task(mirror) returns True once done, False if other mirrors should be
+        tried too, or raises on failure. Returns as soon as task is done on
+        any of the mirrors, or when it hasn't been on any of them. Tasks still
+        running are left to finish in the background.
+        """
+        done = Queue.Queue()
+        budget = transmute.bootstrap._budget.budget
+
+        def run(mirror):
+            transmute.bootstrap._budget.budget = budget
+
+            start = time.time()
+            try: ok = task(mirror)
+            except:
+                self.stats[mirror].failure()
+                ok = False
+            else:
+                self.stats[mirror].success(time.time() - start)
+            done.put(ok)
+
+        running = 0
+        for mirror in self._ranked(mirrors):
+            thread = threading.Thread(target=run, args=(mirror,))
+            thread.daemon = True
+            thread.start()
+            running += 1
+
+            delay = self.stats[mirror].percentile(self.hedge_percentile,
+                    self.hedge_delay)
+            try: ok = done.get(timeout=delay)
+            except Queue.Empty: continue # Hedge with next mirror
+
+            running -= 1
+            if ok:
+                return True
+
+        deadline = time.time() + self.race_timeout
+        while running:
+            try:
+                timeout = deadline - time.time()
+                left = transmute.bootstrap._budget.time_left()
+                if left is not None:
+                    timeout = min(timeout, left)
+                ok = done.get(timeout=max(0., timeout))
+            except (RuntimeError, Queue.Empty):
+                return False # Out of time, leave the stragglers behind
+
+            running -= 1
+            if ok:
+                return True
+        return False
+
+    def _add_mirrored(self, mirror, dist):
+        filename = os.path.basename(dist.location)
+
+        with self._lock:
+            sources = self._sources.get(filename)
+            if sources is None:
+                sources = self._sources[filename] = []
+                self.add_package(filename, sources)
+
+            if not any(dist is d for _, d in sources):
+                sources.append((mirror, dist))
+
+    def fill_environment(self, environment, requirements=None):
+        projects = [ req.project_name for req in requirements or [] ]
+
+        def is_settled(mirror):
+            return hasattr(mirror, '_initialized') \
+                    and all(p in mirror._projects for p in projects)
+
+        def lists_projects(mirror):
+            keys = set(dist.key for dist in mirror.list_distributions())
+            return all(req.key in keys for req in requirements or [])
+
+        def is_complete(mirror):
+            return is_settled(mirror) and mirror._initialized \
+                    and all(mirror._projects[p] for p in projects) \
+                    and lists_projects(mirror)
+
+        def update_mirror(mirror):
+            ok = mirror._initialize()
+            for project in projects:
+                ok = mirror._initialize_project(project) and ok
+            if not ok:
+                raise RuntimeError('Unable to update mirror: %s' % mirror.url)
+
+            # A mirror lacking some of the projects may be lagging behind,
+            # keep looking
+            return lists_projects(mirror)
+
+        # A listing with eggs for all projects is as good as any other
+        if not any(is_complete(mirror) for mirror in self.mirrors):
+            self._race(update_mirror, [ mirror for mirror in self.mirrors
+                    if not is_settled(mirror) ])
+
+        for mirror in self.mirrors:
+            for dist in mirror.list_distributions():
+                self._add_mirrored(mirror, dist)
+
+        Basket.fill_environment(self, environment, requirements)
+
+    def fetch(self, dist, sources):
+        with self._lock:
+            sources = sorted(sources,
+                    key=lambda source: self._rank(source[0]))
+
+        # Prefer copies already available locally. These are copied as they
+        # are, any verification happened when the mirror first fetched them.
+        for mirror, mirror_dist in sources:
+            if os.path.isfile(mirror_dist.location):
+                _copy_file(mirror_dist.location, dist.location)
+                return
+
+        # ... then go for the fastest mirror
+        for mirror, mirror_dist in sources:
+            try: mirror.fetch(dist, mirror_dist._transmute_metadata)
+            except:
+                self.stats[mirror].failure()
+                continue
+
+            self.stats[mirror].success()
+            return
+
+        raise RuntimeError('Unable to fetch from any mirror: %s' % dist)
+
+
+class DaemonBasket(Basket):
+    """A basket served by a transmute daemon, see transmute.daemon.
+
+    Its url is 'transmute://host:port'.
+    """
+
+    def initialize_project(self, project_name):
+        assert self.url.startswith('transmute://')
+
+        url = 'http://%s/projects/%s' % (self.url[12:],
+                urllib.quote(project_name, ''))
+        with contextlib.closing(_urlopen(url)) as response:
+            listing = json.load(response)
+
+        for filename in listing['eggs']:
+            self.add_package(filename, filename)
+
+    def fetch(self, dist, filename):
+        url = 'http://%s/eggs/%s' % (self.url[12:], urllib.quote(filename, ''))
+        with contextlib.closing(_urlopen(url)) as response:
+            _download(throttle_download(response),
+                    dist.location, response.headers['ETag'][1:-1])
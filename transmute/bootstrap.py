@@ -72,9 +72,13 @@ def bootstrap_failed():
 # transmute.bootstrap code follows.
 ################################################################################
 
+import contextlib
 import os
 import os.path
 import sys
+import tempfile
+import threading
+import time
 
 def _chunk_read(file, chunk_size=16*1024):
     """Read file one chunk at a time."""
@@ -103,6 +107,7 @@ def _copy(source, destination, chunk_size):
     """Read source into destination, one chunk at a time."""
 
     for chunk in _chunk_read(source, chunk_size):
+        _budget.time_left()
         destination.write(chunk)
 
 def _download(source, filename, md5sum):
@@ -113,9 +118,6 @@ def _download(source, filename, md5sum):
 
     This will call source.close().
     """
-    import contextlib
-    import tempfile
-
     dirname = os.path.dirname(filename)
     dst = tempfile.NamedTemporaryFile(suffix='.download', dir=dirname)
     with contextlib.closing(dst):
@@ -132,9 +134,85 @@ def _download(source, filename, md5sum):
 
         os.rename(dst.name, filename)
 
-def require(baskets, requirements, entries):
-    """Satisfy requirements from given baskets."""
 
+class _Budget(object):
+    """Deadline for network operations, and a record of work skipped past it."""
+
+    def __init__(self, deadline=None):
+        self.deadline = deadline
+        self.skipped = []
+
+    def expired(self):
+        return self.deadline is not None \
+                and time.time() >= self.deadline
+
+    def time_left(self):
+        """Seconds left before the deadline, None if there is no deadline.
+
+        Raises RuntimeError if the deadline has passed.
+        """
+        if self.deadline is None:
+            return None
+
+        left = self.deadline - time.time()
+        if left <= 0:
+            raise RuntimeError('Time budget exhausted')
+        return left
+
+    def skip(self, what):
+        if self.expired():
+            self.skipped.append(what)
+
+
+class _CurrentBudget(threading.local):
+    """The budget in effect for the current thread."""
+
+    budget = _Budget()
+
+    def expired(self):
+        return self.budget.expired()
+
+    def time_left(self):
+        return self.budget.time_left()
+
+    def skip(self, what):
+        self.budget.skip(what)
+
+
+_budget = _CurrentBudget()
+
+def _urlopen(request):
+    """Open URL, with a timeout matching the current budget."""
+
+    import urllib2
+
+    timeout = _budget.time_left()
+    if timeout is None:
+        return urllib2.urlopen(request)
+    return urllib2.urlopen(request, timeout=timeout)
+
+def require(baskets, requirements, entries, budget=None, unpack=False,
+        deferred=None):
+    """Satisfy requirements from given baskets.
+
+    Network operations are abandoned once the budget's deadline expires, in
+    which case requirements are satisfied from locally cached packages.
+
+    With unpack, eggs are extracted and byte-compiled, and the extracted
+    directories are added to entries in place of the zipped eggs.
+
+    If deferred is a list, packages that are not available locally, but whose
+    top-level modules are known (see Basket._top_level), are not fetched. They
+    are added to deferred instead, to be fetched on first import. Top-level
+    modules of packages made local are remembered for later versions.
+    """
+    previous_budget, _budget.budget = _budget.budget, budget or _Budget()
+    try:
+        _require(baskets, requirements, entries, unpack, deferred)
+    finally:
+        _budget.budget = previous_budget
+
+def _require(baskets, requirements, entries, unpack, deferred=None):
     import pkg_resources
     import zipimport
 
@@ -149,27 +227,80 @@ def require(baskets, requirements, entries):
     while True:
         needed = working_set.resolve(requirements, env=environment)
         missing = []
+        lazy = []
         for dist in needed:
             if dist.location in working_set.entries:
                 continue
             if hasattr(dist, '_transmute_basket'):
-                try: dist._transmute_basket.make_local(dist)
+                if deferred is not None \
+                        and not os.path.isfile(dist.location):
+                    dist._transmute_top_level = \
+                            dist._transmute_basket._top_level(dist)
+                    if dist._transmute_top_level:
+                        dist._transmute_unpack = unpack
+
+                        # Should fetching fail, fall back to a local version
+                        dist._transmute_fallback = None
+                        for other in environment[dist.key]:
+                            if hasattr(other, '_transmute_basket') \
+                                    and os.path.isfile(other.location) \
+                                    and all(other in req
+                                        for req in requirements
+                                        if req.key == dist.key):
+                                dist._transmute_fallback = other
+                                break
+
+                        lazy.append(dist)
+                        continue
+                try: location = dist._transmute_basket.make_local(dist, unpack)
                 except: # Drop dist, start over
+                    _budget.skip('%s (download)' % dist)
                     environment.remove(dist)
                     break
-                dist._provider = pkg_resources.EggMetadata(
-                        zipimport.zipimporter(dist.location))
+                if deferred is not None:
+                    dist._transmute_basket._remember_top_level(dist)
+                if location != dist.location:
+                    dist = pkg_resources.Distribution.from_location(location,
+                            os.path.basename(location),
+                            pkg_resources.PathMetadata(location,
+                                os.path.join(location, 'EGG-INFO')))
+                else:
+                    dist._provider = pkg_resources.EggMetadata(
+                            zipimport.zipimporter(dist.location))
             missing.append(dist)
         else:
             break
 
     entries[0:0] = [ dist.location for dist in missing ]
+    if deferred is not None:
+        deferred.extend(dist for dist in lazy if dist not in deferred)
+
+def _activate(entries):
+    """Add distributions found in entries to pkg_resources' working set.
+
+    This is an incremental alternative to reload(pkg_resources), which would
+    rebuild the working set from scratch and invalidate references held to it.
+    Entries are expected to be on sys.path already, highest priority first.
+    Distributions found in them replace any other versions in the working set.
+    """
+    import pkg_resources
+
+    working_set = pkg_resources.working_set
+    working_set.entries[0:0] = [ entry for entry in entries
+            if entry not in working_set.entries ]
+
+    # Lowest priority first, so the highest priority version wins. Subscribers
+    # to the working set, pkg_resources included, get notified as usual.
+    for entry in reversed(entries):
+        for dist in pkg_resources.find_distributions(entry, True):
+            working_set.add(dist, entry, insert=False, replace=True)
 
 
 class Basket(object):
     """A container for Python Eggs."""
 
     _cache_dir = os.path.expanduser('~/.python-transmute/cache')
+    _unpack_dir = os.path.expanduser('~/.python-transmute/unpacked')
 
     def __init__(self, url=None, path=None):
         assert (path is None) != (url is None)
@@ -179,33 +310,46 @@ class Basket(object):
 
         self.url = url
         self.path = os.path.join(path, '') # Keep trailing separator!
-        self._projects = set()
+        self._projects = {}
         self.distributions = {}
 
     def _initialize(self):
+        """Returns True if remote packages were successfully listed."""
         if hasattr(self, '_initialized'):
-            return
+            return self._initialized
 
-        self._initialized = True
+        self._initialized = False
 
         # Add cached packages first...
         try:
             for filename in os.listdir(self.path):
                 self.add_package(filename)
-        except: pass
+        except:
+            # Local baskets have nothing but the cache
+            if self.url is None:
+                return self._initialized
 
         # ... then let derived classes fill in remote packages
-        try: self.initialize()
-        except: pass
+        self._initialized = self._call_hook(self.initialize)
+        return self._initialized
 
     def _initialize_project(self, project):
+        """Returns True if project was successfully queried."""
         if project in self._projects:
-            return
+            return self._projects[project]
 
-        self._projects.add(project)
+        self._projects[project] = self._call_hook(self.initialize_project,
+                project)
+        return self._projects[project]
 
-        try: self.initialize_project(project)
-        except: pass
+    def _call_hook(self, hook, *args):
+        """Call remote hook, returns True if it succeeded."""
+        try: hook(*args)
+        except:
+            _budget.skip('%s (%s)' % (self.url or self.path,
+                    ' '.join((hook.__name__,) + args)))
+            return False
+        return True
 
     def _prepare_cache(self, url):
         import urllib
@@ -248,12 +392,62 @@ class Basket(object):
             for dist in project_dists:
                 environment.add(dist)
 
-    def make_local(self, dist):
-        if os.path.isfile(dist.location):
-            return
+    def _unpack(self, filename):
+        """Extract and byte-compile egg, returns path to extracted egg.
+
+        Eggs are extracted once for each version of the egg file, into a
+        temporary directory that is atomically renamed when complete.
+        """
+        import compileall
+        import shutil
+        import zipfile
+
+        stat = os.stat(filename)
+        basename = os.path.basename(filename)
+        directory = os.path.join(self._unpack_dir, '%s-%x-%x'
+                % (basename, stat.st_size, int(stat.st_mtime * 1000)))
+        location = os.path.join(directory, basename)
 
-        # Called from within catch-all in top-level require()
-        self.fetch(dist, dist._transmute_metadata)
+        if os.path.isdir(location):
+            return location
+
+        if not os.path.isdir(self._unpack_dir):
+            os.makedirs(self._unpack_dir)
+
+        tmp = tempfile.mkdtemp(suffix='.unpack', dir=self._unpack_dir)
+        try:
+            with zipfile.ZipFile(filename) as egg:
+                egg.extractall(os.path.join(tmp, basename))
+            compileall.compile_dir(os.path.join(tmp, basename),
+                    ddir=location, quiet=1)
+            os.rename(tmp, directory)
+        except:
+            shutil.rmtree(tmp, True)
+
+            # Lost the race to another process?
+            if not os.path.isdir(location):
+                raise
+
+        return location
+
+    def _top_level(self, dist):
+        """Top-level modules of dist, if known without fetching it."""
+        return None
+
+    def _remember_top_level(self, dist):
+        """Note top-level modules of dist, now local, for _top_level()."""
+        pass
+
+    def make_local(self, dist, unpack=False):
+        """Returns location of local copy of dist, fetching it as needed."""
+
+        if not os.path.isfile(dist.location):
+            # Called from within catch-all in top-level require()
+            self.fetch(dist, dist._transmute_metadata)
+
+        if unpack:
+            return self._unpack(dist.location)
+        return dist.location
 
     # Hooks for implementing custom baskets.
     #
@@ -282,17 +476,14 @@ class PyPIBasket(Basket):
     pypi_url = 'https://pypi.python.org/pypi'
 
     def fetch(self, dist, metadata):
-        import urllib2
-
-        _download(urllib2.urlopen(metadata['url']),
+        _download(_urlopen(metadata['url']),
                 dist.location, metadata['md5_digest'])
 
     def initialize_project(self, project_name):
         import json
-        import urllib2
 
         url = '%s/%s/json' % (self.url, project_name)
-        req = urllib2.urlopen(url)
+        req = _urlopen(url)
         metadata = json.load(req)
 
         for package in metadata['urls']:
@@ -314,16 +505,15 @@ def bootstrap():
     Latest packages are downloaded from PyPI, if available, and added to
     sys.path.
     """
-    import pkg_resources
-
     bootstrap_starting()
 
+    entries = list(sys.path)
     try:
         require([ PYPI_BASKET ], requirements, sys.path)
     except:
         bootstrap_failed()
     else:
-        reload(pkg_resources)
+        _activate([ entry for entry in sys.path if entry not in entries ])
         bootstrap_succeeded()
 
 def _clean_namespace():
@@ -332,10 +522,14 @@ def _clean_namespace():
     Used prior to a reload() of the module when the present module is used to
     bootstrap the Real Thing (tm).
     """
-    global __doc__, os, sys
+    global __doc__, contextlib, os, sys, tempfile, threading, time
     del __doc__
+    del contextlib
     del os
     del sys
+    del tempfile
+    del threading
+    del time
 
     global requirements, main, bootstrap_starting, bootstrap_succeeded, \
             bootstrap_failed
@@ -351,8 +545,16 @@ def _clean_namespace():
     del _copy
     del _download
 
-    global require, Basket, PyPIBasket, PYPI_BASKET
+    global _Budget, _CurrentBudget, _budget, _urlopen
+    del _Budget
+    del _CurrentBudget
+    del _budget
+    del _urlopen
+
+    global require, _require, _activate, Basket, PyPIBasket, PYPI_BASKET
     del require
+    del _require
+    del _activate
     del Basket
     del PyPIBasket
     del PYPI_BASKET
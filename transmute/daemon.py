@@ -0,0 +1,209 @@
+#   Copyright 2014 Telenor Digital AS
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#   use this file except in compliance with the License. You may obtain a copy
+#   of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+
+"""Host-local cache of remote baskets.
+
+A long-running daemon keeps listings of configured baskets fresh in the
+background and serves them, along with the eggs themselves, over loopback HTTP.
+Client processes use it as a basket with a 'transmute://host:port' url, so that
+remote traffic scales with the number of hosts rather than process launches:
+
+    $ python -m transmute.daemon s3://bucket/eggs https://pypi.python.org/pypi
+
+    transmute.require([ 'foobar' ], sources=[ 'transmute://127.0.0.1:7460' ])
+
+The daemon answers two kinds of requests:
+
+    GET /projects/<project>: JSON listing of eggs available for project, as
+        { "eggs": [ <filename>, ... ] }. Projects are tracked, and kept fresh,
+        from the first time they're requested.
+    GET /eggs/<filename>: The egg itself, with its MD5 hash in the ETag header.
+"""
+
+import BaseHTTPServer
+import json
+import os.path
+import shutil
+import SocketServer
+import threading
+import time
+import urllib
+
+import pkg_resources
+import transmute.basket
+import transmute.bootstrap
+from transmute.bootstrap import _md5
+
+DEFAULT_PORT = 7460
+
+
+class Daemon(object):
+    """Keep a set of baskets fresh, and serve them to local processes."""
+
+    # Seconds each request may spend on remote baskets
+    request_budget = 5.
+
+    def __init__(self, sources, interval=300., address=None):
+        """Initialize a new Daemon.
+
+        sources: urls of baskets to cache, in order of preference.
+        interval: seconds between refreshes of basket listings.
+        address: (host, port) tuple to listen on, defaults to loopback.
+        """
+        self.sources = list(sources)
+        self.interval = interval
+        self.address = address or ('127.0.0.1', DEFAULT_PORT)
+
+        self.projects = set()
+        self._lock = threading.Lock()
+        self.refresh()
+
+    def _load_baskets(self):
+        # Fresh basket instances, bypassing the global registry
+        baskets = [ transmute.basket._get_basket(url) for url in self.sources ]
+        for basket in baskets:
+            basket._initialize()
+            with self._lock:
+                projects = list(self.projects)
+            for project in projects:
+                basket._initialize_project(project)
+        return baskets
+
+    @staticmethod
+    def _with_budget(budget, function, *args):
+        current = transmute.bootstrap._budget
+        previous, current.budget = current.budget, budget
+        try:
+            return function(*args)
+        finally:
+            current.budget = previous
+
+    def refresh(self):
+        """Re-read listings of remote baskets, within one interval."""
+
+        # A hanging basket mustn't hold up the next refresh
+        budget = transmute.bootstrap._Budget(time.time() + self.interval)
+
+        # Replaced in one go, requests are served from the old listings
+        # meanwhile
+        self.baskets = self._with_budget(budget, self._load_baskets)
+
+    def list_project(self, project):
+        key = pkg_resources.safe_name(project).lower()
+
+        baskets = self.baskets
+        with self._lock:
+            self.projects.add(key)
+
+        # Baskets query each project once, concurrent requests wait for it
+        for basket in baskets:
+            basket._initialize()
+            basket._initialize_project(project)
+
+        eggs = []
+        for basket in baskets:
+            for dist in basket.list_distributions():
+                filename = os.path.basename(dist.location)
+                if dist.key == key and filename not in eggs:
+                    eggs.append(filename)
+        return eggs
+
+    def get_egg(self, filename):
+        """Returns path to a local copy of egg, fetching it as needed."""
+
+        for basket in self.baskets:
+            for dist in basket.list_distributions():
+                if os.path.basename(dist.location) != filename:
+                    continue
+                try: return basket.make_local(dist)
+                except: pass
+
+        return None
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self.interval)
+            try: self.refresh()
+            except: pass
+
+    def serve_forever(self):
+        refresher = threading.Thread(target=self._refresh_loop)
+        refresher.daemon = True
+        refresher.start()
+
+        server = _Server(self.address, _RequestHandler)
+        server.transmute_daemon = self
+        server.serve_forever()
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        daemon = self.server.transmute_daemon
+        kind, _, name = self.path.lstrip('/').partition('/')
+        name = urllib.unquote(name)
+
+        budget = transmute.bootstrap._Budget(
+                time.time() + daemon.request_budget)
+
+        if kind == 'projects' and name:
+            eggs = daemon._with_budget(budget, daemon.list_project, name)
+            body = json.dumps({ 'eggs': eggs })
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        if kind == 'eggs' and name:
+            filename = daemon._with_budget(budget, daemon.get_egg, name)
+            if filename is not None:
+                with open(filename, 'rb') as egg:
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/octet-stream')
+                    self.send_header('Content-Length',
+                            str(os.path.getsize(filename)))
+                    self.send_header('ETag', '"%s"' % _md5(filename))
+                    self.end_headers()
+                    shutil.copyfileobj(egg, self.wfile)
+                return
+
+        self.send_error(404)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='python -m transmute.daemon',
+            description='Serve a host-local cache of transmute baskets.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--interval', type=float, default=300.,
+            help='seconds between refreshes of basket listings')
+    parser.add_argument('sources', nargs='+', metavar='source')
+    args = parser.parse_args(argv)
+
+    Daemon(args.sources, args.interval, (args.host, args.port)).serve_forever()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+#   Copyright 2014 Telenor Digital AS
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#   use this file except in compliance with the License. You may obtain a copy
+#   of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+
+import imp
+import os.path
+import pkgutil
+import sys
+import threading
+import time
+import transmute.bootstrap
+import urllib
+
+_cache_dir = os.path.expanduser('~/.python-transmute/top_level')
+
+def _read_top_level(location):
+    if os.path.isdir(location):
+        with open(os.path.join(location, 'EGG-INFO', 'top_level.txt')) as f:
+            return f.read()
+
+    import zipfile
+    with zipfile.ZipFile(location) as egg:
+        return egg.read('EGG-INFO/top_level.txt')
+
+def _write_cache(cache, content):
+    import contextlib
+    import tempfile
+
+    if not os.path.isdir(_cache_dir):
+        os.makedirs(_cache_dir)
+
+    dst = tempfile.NamedTemporaryFile(suffix='.tmp', dir=_cache_dir,
+            delete=False)
+    with contextlib.closing(dst):
+        dst.write(content)
+    os.rename(dst.name, cache)
+
+def top_level(location):
+    """List top-level modules in egg at location.
+
+    The list is read from the egg's top_level.txt and cached under
+    ~/.python-transmute, keyed by the egg's path and modification time. Returns
+    None if the egg doesn't provide one.
+    """
+    try: mtime = os.path.getmtime(location)
+    except OSError: return None
+
+    cache = os.path.join(_cache_dir, '%s-%x'
+            % (urllib.quote(location, ''), int(mtime * 1000)))
+
+    try:
+        with open(cache) as cache_file:
+            return cache_file.read().split()
+    except: pass
+
+    try: content = _read_top_level(location)
+    except: return None
+
+    try: _write_cache(cache, content)
+    except: pass
+
+    return content.split()
+
+
+class IndexedImporter(object):
+    """Find top-level modules in eggs through an index.
+
+    Installed in sys.meta_path, this takes the place of one sys.path entry per
+    egg. Top-level modules are looked up in a single dictionary regardless of
+    the number of eggs, submodules are then found through their package's
+    __path__ as usual.
+    """
+
+    def __init__(self):
+        self.index = {}
+
+    def add(self, location):
+        """Add egg to index, returns False if that is not possible."""
+
+        names = top_level(location)
+        if not names \
+                or any(name in self.index for name in names):
+            return False
+
+        for name in names:
+            self.index[name] = location
+        return True
+
+    def install(self):
+        sys.meta_path.insert(0, self)
+
+    def uninstall(self):
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    def find_module(self, fullname, path=None):
+        if path is not None:
+            return None
+
+        location = self.index.get(fullname)
+        if location is None:
+            return None
+
+        importer = pkgutil.get_importer(location)
+        if importer is None:
+            return None
+        return importer.find_module(fullname)
+
+
+class LazyImporter(object):
+    """Fetch eggs on first import of one of their top-level modules.
+
+    Installed in sys.meta_path, this holds placeholders for distributions that
+    were resolved but not yet fetched (see Resolver). The first import of a
+    module listed in a distribution's top_level.txt fetches it and adds it to
+    sys.path and pkg_resources' working set, the import then proceeds as usual.
+    If the fetch fails, the newest local version satisfying requirements, if
+    any, is activated instead.
+
+    Eggs are fetched and activated under the import lock, so other threads
+    don't get to see modules importing them half-initialized. Each fetch is
+    limited to budget seconds.
+    """
+
+    budget = 60.
+
+    def __init__(self):
+        self.index = {}
+        self.pending = []
+        self.failed = []
+        self._lock = threading.Lock()
+
+    def add(self, dist):
+        names = dist._transmute_top_level
+        if any(name in self.index for name in names):
+            return False
+
+        for name in names:
+            self.index[name] = dist
+        with self._lock:
+            self.pending.append(dist)
+        return True
+
+    def install(self):
+        sys.meta_path.insert(0, self)
+
+    def uninstall(self):
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    def _make_local(self, dist, unpack, wait=True):
+        budget = transmute.bootstrap._Budget(time.time() + self.budget)
+        current = transmute.bootstrap._budget
+        previous, current.budget = current.budget, budget
+        try:
+            return dist._transmute_basket.make_local(dist, unpack, wait)
+        finally:
+            current.budget = previous
+
+    def _fetch(self, dist):
+        # Don't wait for the same egg being prefetched. The prefetch thread may
+        # itself be waiting for the import lock held here.
+        unpack = dist._transmute_unpack
+        try: return self._make_local(dist, unpack, False)
+        except: self.failed.append(dist)
+
+        fallback = dist._transmute_fallback
+        if fallback is not None:
+            try: return self._make_local(fallback, unpack, False)
+            except: pass
+        return None
+
+    def activate(self, dist):
+        """Fetch dist and make it importable, returns its location or None."""
+
+        # Already held by imports, re-entrant
+        imp.acquire_lock()
+        try:
+            with self._lock:
+                if dist not in self.pending:
+                    return None
+            location = self._fetch(dist)
+
+            with self._lock:
+                self.pending.remove(dist)
+            for name in dist._transmute_top_level:
+                self.index.pop(name, None)
+
+            if location is not None:
+                sys.path.insert(0, location)
+                transmute.bootstrap._activate([ location ])
+            return location
+        finally:
+            imp.release_lock()
+
+    def _prefetch(self):
+        with self._lock:
+            pending = list(self.pending)
+
+        # Only made local here, without the import lock, eggs are activated on
+        # first import
+        for dist in pending:
+            try: self._make_local(dist, dist._transmute_unpack)
+            except: pass
+
+    def prefetch(self):
+        """Fetch pending eggs in a background thread.
+
+        Eggs are activated on first import, as usual. Imports don't wait for
+        eggs still being prefetched, they fetch them alongside.
+        """
+        thread = threading.Thread(target=self._prefetch)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def find_module(self, fullname, path=None):
+        if path is not None:
+            return None
+
+        dist = self.index.get(fullname)
+        if dist is not None:
+            self.activate(dist)
+        return None
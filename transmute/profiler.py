@@ -0,0 +1,151 @@
+#   Copyright 2014 Telenor Digital AS
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#   use this file except in compliance with the License. You may obtain a copy
+#   of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+
+import imp
+import os.path
+import pkgutil
+import sys
+import time
+
+class ImportProfiler(object):
+    """Attribute import time to distributions in a working set.
+
+    Installed in sys.meta_path, the profiler wraps every import, timing it and
+    noting where the module came from: a zipped egg or a directory, and whether
+    it was loaded from bytecode or compiled from source.
+    """
+
+    def __init__(self, working_set):
+        self.working_set = working_set
+        self.modules = {}
+        self._loaders = {}
+        self._children = []
+
+    def install(self):
+        sys.meta_path.insert(0, self)
+
+    def uninstall(self):
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    def _find_loader(self, fullname, path):
+        for finder in sys.meta_path:
+            if finder is not self:
+                loader = finder.find_module(fullname, path)
+                if loader is not None:
+                    return loader
+
+        if path is None:
+            if imp.is_builtin(fullname) or imp.is_frozen(fullname):
+                return None
+            path = sys.path
+
+        for entry in path:
+            importer = pkgutil.get_importer(entry)
+            if importer is not None:
+                loader = importer.find_module(fullname)
+                if loader is not None:
+                    return loader
+        return None
+
+    def find_module(self, fullname, path=None):
+        loader = self._find_loader(fullname, path)
+        if loader is None:
+            return None
+
+        self._loaders[fullname] = loader
+        return self
+
+    def load_module(self, fullname):
+        loader = self._loaders.pop(fullname)
+
+        self._children.append(0.)
+        start = time.time()
+        try:
+            module = loader.load_module(fullname)
+        finally:
+            elapsed = time.time() - start
+            children = self._children.pop()
+            if self._children:
+                self._children[-1] += elapsed
+
+        self._record(fullname, module, elapsed, elapsed - children)
+        return module
+
+    def _find_dist(self, filename):
+        for dist in self.working_set:
+            if dist.location \
+                    and filename.startswith(os.path.join(dist.location, '')):
+                return dist
+        return None
+
+    def _record(self, fullname, module, cumulative, seconds):
+        filename = getattr(module, '__file__', None) or ''
+        dist = self._find_dist(filename)
+
+        if filename.endswith(('.pyc', '.pyo')):
+            source = 'bytecode'
+        elif filename.endswith('.py'):
+            source = 'compiled'
+        else:
+            source = 'extension' if filename else 'builtin'
+
+        self.modules[fullname] = {
+            'dist': dist,
+            'seconds': seconds,
+            'cumulative': cumulative,
+            'source': source,
+        }
+
+    def report(self):
+        """Import statistics per distribution.
+
+        Returns a dict keyed by distributions in the working set, None for
+        modules from elsewhere. Values are dicts with the following keys:
+
+            seconds: time spent importing modules from the distribution,
+                excluding nested imports of other modules.
+            location: 'zip' or 'directory'.
+            modules: dict of module name to (seconds, source), where source is
+                one of 'bytecode', 'compiled', 'extension' or 'builtin'.
+        """
+        report = {}
+        for fullname, stats in self.modules.items():
+            dist = stats['dist']
+            if dist not in report:
+                report[dist] = {
+                    'seconds': 0.,
+                    'location': None if dist is None
+                        else 'zip' if os.path.isfile(dist.location)
+                        else 'directory',
+                    'modules': {},
+                }
+
+            entry = report[dist]
+            entry['seconds'] += stats['seconds']
+            entry['modules'][fullname] = stats['seconds'], stats['source']
+
+        return report
+
+    def print_report(self, file=None):
+        file = file or sys.stderr
+
+        report = self.report()
+        for dist, entry in sorted(report.items(),
+                key=lambda item: item[1]['seconds'], reverse=True):
+            compiled = sum(1 for _, source in entry['modules'].values()
+                    if source == 'compiled')
+            print >>file, '%8.4fs %-40s %-9s %3d modules, %d compiled' % (
+                    entry['seconds'], dist or '(other)',
+                    entry['location'] or '', len(entry['modules']), compiled)
@@ -16,23 +16,47 @@ import os.path
 import transmute.basket
 import transmute.bootstrap
 import sys
+import threading
+import time
 
 class Resolver:
-    """Find and manage lists of updated packages."""
+    """Find and manage lists of updated packages.
 
-    def __init__(self, requirements=None, sources=None):
+    require() may be called from multiple threads at once. Each call resolves
+    against a snapshot of entries, merged back in once it completes.
+    """
+
+    def __init__(self, requirements=None, sources=None, budget=None,
+            unpack=False, lazy=False):
         """Initialize a new Resolver object.
 
         requirements: string or list of strings listing package requirements.
+        budget: time limit for network operations, in seconds, see set_budget.
+        unpack: extract and byte-compile eggs, instead of importing them from
+            zip files.
+        lazy: leave packages whose top-level modules are known from earlier
+            versions unfetched, in deferred. They're fetched on first import
+            once transmuted.
         """
+        self._lock = threading.RLock()
         self.baskets = []
-        self.entries = [ entry for entry in sys.path if os.path.isfile(entry) ]
+        self.entries = [ entry for entry in sys.path if self._is_egg(entry) ]
+        self.unpack = unpack
+        self.lazy = lazy
+        self.deferred = []
+        self.skipped = []
+        self.set_budget(budget)
 
         if sources:
             self.add_source(*sources)
         if requirements:
             self.require(requirements)
 
+    @staticmethod
+    def _is_egg(entry):
+        return os.path.isfile(entry) \
+                or os.path.isdir(os.path.join(entry, 'EGG-INFO'))
+
     @classmethod
     def _get_basket(cls, source):
         if isinstance(source, basestring):
@@ -44,12 +68,60 @@ class Resolver:
         return [ cls._get_basket(s) for s in sources ]
 
     def add_source(self, *sources):
-        self.baskets.extend(self._get_baskets(sources))
+        with self._lock:
+            self.baskets.extend(self._get_baskets(*sources))
+
+    def set_budget(self, budget):
+        """Limit time spent on the network by subsequent calls to require().
+
+        budget: seconds from now, shared by all subsequent calls. Once it is
+            exhausted, requirements are fulfilled from locally cached packages
+            and pending network operations are skipped, and listed in skipped.
+            None lifts the limit.
+        """
+        self.deadline = None if budget is None else time.time() + budget
+
+    def require(self, requirements, sources=None, budget=None, unpack=None,
+            lazy=None):
+        """Fulfill requirements, downloading updated packages as needed.
 
-    def require(self, requirements, sources=None):
-        baskets = self.baskets
+        budget: optional time limit for this call, in seconds. Applies on top
+            of any limit set with set_budget.
+        unpack: overrides the resolver's unpack setting for this call.
+        lazy: overrides the resolver's lazy setting for this call.
+        """
+        with self._lock:
+            baskets = list(self.baskets)
         if sources:
-            # Make a copy
-            baskets = baskets + self._get_baskets(*sources)
+            baskets += self._get_baskets(*sources)
+
+        deadline = self.deadline
+        if budget is not None:
+            deadline = min(deadline or float('inf'), time.time() + budget)
+
+        if unpack is None:
+            unpack = self.unpack
+        if lazy is None:
+            lazy = self.lazy
+
+        with self._lock:
+            entries = list(self.entries)
+            deferred = [] if lazy else None
+        known = len(entries)
+
+        budget = transmute.bootstrap._Budget(deadline)
+        try:
+            transmute.bootstrap.require(baskets, requirements, entries, budget,
+                    unpack, deferred)
+        finally:
+            # New entries are prepended to the snapshot
+            self._merge(entries[:len(entries) - known], deferred or [],
+                    budget.skipped)
 
-        transmute.bootstrap.require(baskets, requirements, self.entries)
+    def _merge(self, entries, deferred, skipped):
+        with self._lock:
+            self.entries[0:0] = [ entry for entry in entries
+                    if entry not in self.entries ]
+            self.deferred.extend(dist for dist in deferred
+                    if dist not in self.deferred)
+            self.skipped.extend(skipped)
@@ -18,12 +18,14 @@ import hashlib
 import hmac
 import json
 import os
+import random
 import urllib
 import urllib2
 import xml.etree.ElementTree
 
-from transmute.basket import Basket
-from transmute.bootstrap import _download
+from transmute.basket import Basket, _is_throttled, _retry_after, _sleep, \
+        throttle_download
+from transmute.bootstrap import _download, _urlopen
 
 
 def _get_s3_endpoint():
@@ -74,17 +76,38 @@ class _S3BucketFolder:
     endpoint = _get_s3_endpoint()
     access_key, secret_key, security_token = _get_aws_credentials()
 
+    # Retries of requests throttled by S3 (503 SlowDown)
+    max_retries = 3
+    retry_backoff = 0.5
+    max_retry_delay = 5.
+
     def __init__(self, bucket, prefix=''):
         self.bucket = bucket
         self.prefix = prefix + '/'
 
     def _request(self, path, query=None):
-        headers = { 'Host': self.bucket }
-        self._authenticate_request(path, headers)
-        url = self.endpoint + path + (query or '')
+        for attempt in range(self.max_retries + 1):
+            headers = { 'Host': self.bucket }
+            self._authenticate_request(path, headers)
+            url = self.endpoint + path + (query or '')
+
+            request = urllib2.Request(url, headers=headers)
+            try: response = _urlopen(request)
+            except urllib2.HTTPError as error:
+                if attempt == self.max_retries \
+                        or not _is_throttled(error):
+                    raise
+
+                backoff = self.retry_backoff * 2 ** attempt
+                delay = max(random.uniform(backoff / 2, backoff),
+                        _retry_after(error, 0.))
+                if delay > self.max_retry_delay:
+                    raise
+                _sleep(delay)
+                continue
+
+            break
 
-        request = urllib2.Request(url, headers=headers)
-        response = urllib2.urlopen(request)
         if response.getcode() == 200:
             return response
 
@@ -166,4 +189,4 @@ class S3Basket(Basket):
 
     def fetch(self, dist, filename):
         md5sum, data = self.s3_bucket.get_object(filename)
-        _download(data, dist.location, md5sum)
+        _download(throttle_download(data), dist.location, md5sum)
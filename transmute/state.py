@@ -0,0 +1,74 @@
+#   Copyright 2014 Telenor Digital AS
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may not
+#   use this file except in compliance with the License. You may obtain a copy
+#   of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+
+"""Bookkeeping about baskets, persisted across runs.
+
+State is kept as one small JSON document per basket, and is strictly advisory:
+failure to read or write it is never fatal. Different parts of the code own
+different sections of a basket's document, and go through update() to change
+them.
+"""
+
+import contextlib
+import json
+import os
+import os.path
+import tempfile
+import threading
+import urllib
+
+_state_dir = os.path.expanduser('~/.python-transmute/state')
+_lock = threading.Lock()
+
+def basket_key(basket):
+    """Identify basket across runs."""
+    return basket.url or basket.path
+
+def _filename(key):
+    return os.path.join(_state_dir, urllib.quote(key, '') + '.json')
+
+def load(key):
+    try:
+        with open(_filename(key)) as state_file:
+            state = json.load(state_file)
+        if isinstance(state, dict):
+            return state
+    except: pass
+
+    return {}
+
+def save(key, state):
+    """Atomically replace persisted state for key."""
+
+    try:
+        if not os.path.isdir(_state_dir):
+            os.makedirs(_state_dir)
+
+        dst = tempfile.NamedTemporaryFile(suffix='.tmp', dir=_state_dir,
+                delete=False)
+        with contextlib.closing(dst):
+            json.dump(state, dst)
+        os.rename(dst.name, _filename(key))
+    except: pass
+
+def update(key, sections):
+    """Replace some sections of persisted state for key, keeping the others.
+
+    Updates are serialized within the process, so that concurrent updates to
+    different sections don't undo each other.
+    """
+    with _lock:
+        state = load(key)
+        state.update(sections)
+        save(key, state)
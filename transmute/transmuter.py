@@ -16,12 +16,39 @@ import os
 import pkg_resources
 import sys
 import transmute.bootstrap
+from transmute.importer import IndexedImporter, LazyImporter
+from transmute.profiler import ImportProfiler
 
 class Transmuter(object):
     """Manage updates to Python's module search path."""
 
-    def __init__(self, entries):
+    def __init__(self, entries, profile_imports=False, indexed=False,
+            deferred=(), prefetch=False):
+        """Initialize a new Transmuter.
+
+        profile_imports: install an ImportProfiler after transmuting, see
+            import_profiler.
+        indexed: on soft transmutes, make eggs available through a single
+            IndexedImporter, instead of one sys.path entry per egg. Eggs that
+            can't be indexed are still added to sys.path.
+        deferred: distributions left unfetched by a lazy Resolver. On soft
+            transmutes, they're fetched on first import through lazy_importer.
+        prefetch: fetch deferred distributions in the background meanwhile.
+        """
         self.working_set = pkg_resources.WorkingSet(entries)
+        self.import_profiler = None
+        if profile_imports:
+            self.import_profiler = ImportProfiler(self.working_set)
+        self.importer = IndexedImporter() if indexed else None
+
+        self.deferred = [ dist for dist in deferred
+                if dist.location not in entries ]
+        self.prefetch = prefetch
+        self.lazy_importer = None
+        if self.deferred:
+            self.lazy_importer = LazyImporter()
+            for dist in self.deferred:
+                self.lazy_importer.add(dist)
 
     @staticmethod
     def _dist_conflicts(dist):
@@ -29,23 +56,65 @@ class Transmuter(object):
                 for module in dist._get_metadata('top_level.txt'))
 
     def _has_conflicts(self):
-        return any(self._dist_conflicts(dist) for dist in self.working_set)
+        return any(self._dist_conflicts(dist) for dist in self.working_set) \
+                or any(module in sys.modules for dist in self.deferred
+                    for module in dist._transmute_top_level)
+
+    def _reset_path(self, indexed=()):
+        sys.path[0:0] = [ entry for entry in self.working_set.entries
+                if entry not in indexed ]
 
-    def _reset_path(self):
-        sys.path[0:0] = self.working_set.entries
+    def _index(self, dist):
+        # Namespace packages are spread over several eggs, leave them to
+        # pkg_resources
+        return self.importer is not None \
+                and not dist.has_metadata('namespace_packages.txt') \
+                and self.importer.add(dist.location)
+
+    @staticmethod
+    def _register_indexed(locations):
+        # Indexed eggs are not in sys.path, register them explicitly. Callbacks
+        # are held back, pkg_resources' own would add eggs to sys.path.
+        working_set = pkg_resources.working_set
+        callbacks, working_set.callbacks = working_set.callbacks, []
+        try:
+            for location in locations:
+                for dist in pkg_resources.find_distributions(location, True):
+                    working_set.add(dist, location, replace=True)
+        finally:
+            working_set.callbacks = callbacks
 
     def soft_transmute(self):
-        for dist in self.working_set:
-            dist.activate()
+        indexed = [ dist for dist in self.working_set if self._index(dist) ]
+        indexed_entries = [ dist.location for dist in indexed ]
 
-        self._reset_path()
-        reload(pkg_resources)
+        self._reset_path(indexed_entries)
+        transmute.bootstrap._activate([ entry
+                for entry in self.working_set.entries
+                if entry not in indexed_entries ])
+
+        if indexed:
+            self._register_indexed([ dist.location for dist in indexed ])
+
+        if self.importer:
+            self.importer.install()
+        if self.lazy_importer:
+            self.lazy_importer.install()
+            if self.prefetch:
+                self.lazy_importer.prefetch()
+        if self.import_profiler:
+            self.import_profiler.install()
 
     def hard_transmute(self):
         self.executable = sys.executable
         self.arguments = [ self.executable ] + sys.argv
         self.environment = os.environ.copy()
 
+        # Deferred eggs can't follow through exec, fetch them now
+        if self.lazy_importer:
+            for dist in list(self.lazy_importer.pending):
+                self.lazy_importer.activate(dist)
+
         # Reset PYTHONPATH
         self._reset_path()
         self.environment['PYTHONPATH'] = os.pathsep.join(sys.path)